@@ -0,0 +1,45 @@
+"""Static assets
+
+Resolves static files to the minified, fingerprinted copies that
+`gulp build` writes to static/dist (see gulpfile.js), using the manifest
+it writes to rev-manifest.json. Fingerprinted files never change, so app.yaml lets
+browsers cache them for a year.
+
+Without a build, as when running dev_appserver.py on a fresh checkout,
+assets resolve to their source files.
+
+"""
+
+import json
+import os
+
+ROOT = os.path.dirname(__file__)
+
+def _load_json(path, default):
+    """Load a JSON file, or default if it doesn't exist"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except IOError:
+        return default
+
+# bundle name -> source files, shared with gulpfile.js
+bundles = _load_json(os.path.join(ROOT, 'assets.json'), {})
+# path in static/ -> fingerprinted path in static/dist/
+manifest = _load_json(os.path.join(ROOT, 'rev-manifest.json'), {})
+
+def asset_url(path):
+    """URL of a static file, given its path in static/, e.g.
+    asset_url('img/penguin_small.svg')
+    """
+    if path in manifest:
+        return '/static/dist/%s' % manifest[path]
+    return '/static/%s' % path
+
+def asset_urls(bundle):
+    """URLs to include for a bundle of CSS or JS files (see assets.json):
+    just the bundle once built, else each of its source files
+    """
+    if bundle in manifest:
+        return [asset_url(bundle)]
+    return [asset_url(path) for path in bundles[bundle]]
@@ -0,0 +1,273 @@
+"""Load benchmark
+
+Boots the app in-process on the App Engine testbed stubs (datastore,
+memcache, task queue and search), seeds it with users, posts, comments
+and likes, then drives the app's main routes with concurrent clients.
+For each route it reports requests per second, p50/p95/p99 latency and
+the datastore and memcache RPCs made per request, as a table or as JSON
+for tracking regressions between runs.
+
+Run from the project root with the App Engine SDK on PYTHONPATH:
+`python bench/load.py --posts 200 --clients 4 --json -o results.json`
+
+The stubs run in this process, so absolute numbers are not production
+numbers; compare runs made on the same machine.
+
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+
+PASSWORD = 'password'
+WORDS = ('app engine datastore memcache python jinja template cursor '
+         'counter shard cache page search query index entity group '
+         'transaction task queue render cookie login blog post comment '
+         'like').split()
+
+_rpcs = threading.local()
+
+def count_rpc(service, call, request, response):
+    """Pre-call hook counting the API calls made by the current thread"""
+    counts = getattr(_rpcs, 'counts', None)
+    if counts is not None:
+        counts[service] = counts.get(service, 0) + 1
+
+def setup_testbed():
+    """Activate the testbed stubs the app uses, before importing it"""
+    bed = testbed.Testbed()
+    bed.activate()
+    # not 'Development', so settings.DEBUG is off as in production
+    bed.setup_env(overwrite=True, app_id='blog-bench',
+                  CURRENT_VERSION_ID='bench.1',
+                  SERVER_SOFTWARE='Google App Engine/bench')
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=ROOT)
+    bed.init_search_stub()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'bench-rpc-count', count_rpc)
+    return bed
+
+def text(words):
+    """Random text of some words"""
+    return ' '.join(random.choice(WORDS) for _ in xrange(words))
+
+def seed(users, posts, comments, likes):
+    """Seed the datastore, returning the users (with their session
+    cookies) and the post ids
+    """
+    import handler
+    from blog import blog_model, blog_search
+
+    accounts = []
+    for i in xrange(users):
+        name = 'user%d' % i
+        user = handler.user_register(
+            name, handler.make_pw_hash(name, PASSWORD))
+        cookie = 'user_id=%s' % handler.make_secure_val(
+            '%s:%s' % (user.key.id(), name))
+        accounts.append((name, cookie))
+
+    post_ids = []
+    for _ in xrange(posts):
+        author = random.choice(accounts)[0]
+        post = blog_model.Post(parent=blog_model.post_parent(),
+                               author=author, subject=text(5),
+                               content=text(200))
+        post.put()
+        blog_search.index_post(post)
+        post_id = str(post.key.id())
+        post_ids.append(post_id)
+
+        for _ in xrange(comments):
+            comment = blog_model.Comment(
+                parent=blog_model.thread_key(post_id), post_id=post_id,
+                author=random.choice(accounts)[0], content=text(40))
+            comment.put()
+            blog_search.index_comment(comment)
+
+        fans = [name for name, _ in accounts if name != author]
+        for name in random.sample(fans, min(likes, len(fans))):
+            blog_model.like_post(post_id, name)
+
+    return accounts, post_ids
+
+def routes(accounts, post_ids):
+    """Benchmarked routes: name -> function returning (method, path,
+    form, cookie) for one request
+    """
+    def anon():
+        return None
+
+    def user():
+        return random.choice(accounts)[1]
+
+    def post_id():
+        return random.choice(post_ids)
+
+    def login():
+        name = random.choice(accounts)[0]
+        return ('POST', '/login', {'username': name, 'password': PASSWORD},
+                None)
+
+    return {
+        'front': lambda: ('GET', '/blog', None, anon()),
+        'front-user': lambda: ('GET', '/blog', None, user()),
+        'post': lambda: ('GET', '/blog/%s' % post_id(), None, anon()),
+        'post-user': lambda: ('GET', '/blog/%s' % post_id(), None, user()),
+        'search': lambda: ('GET', '/blog/search?' + urllib.urlencode(
+            {'q': random.choice(WORDS)}), None, anon()),
+        'login': login,
+        'like': lambda: ('GET', '/blog/like/%s' % post_id(), None, user()),
+        'unlike': lambda: ('GET', '/blog/unlike/%s' % post_id(), None,
+                           user()),
+    }
+
+def percentile(timings, pct):
+    """Get a percentile of sorted timings"""
+    return timings[min(len(timings) - 1, int(len(timings) * pct / 100.0))]
+
+def run_route(app, make_request, requests, clients):
+    """Send requests requests to app from clients threads, returning
+    their stats
+    """
+    import webob
+
+    timings = []
+    rpcs = []
+    errors = [0]
+    remaining = [requests]
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                if not remaining[0]:
+                    return
+                remaining[0] -= 1
+            method, path, form, cookie = make_request()
+            request = webob.Request.blank(path, POST=form)
+            request.method = method
+            # a different client each time, so the benchmark measures the
+            # routes rather than the rate limits in main.py
+            request.remote_addr = '10.%d.%d.%d' % tuple(
+                random.randint(0, 255) for _ in xrange(3))
+            if cookie:
+                request.headers['Cookie'] = cookie
+            # every request starts with an empty ndb context, as it would
+            # on App Engine
+            ndb.set_context(ndb.make_default_context())
+            _rpcs.counts = {}
+            start = time.time()
+            response = request.get_response(app)
+            elapsed = (time.time() - start) * 1000
+            with lock:
+                timings.append(elapsed)
+                rpcs.append(_rpcs.counts)
+                if response.status_int >= 400:
+                    errors[0] += 1
+            _rpcs.counts = None
+
+    start = time.time()
+    threads = [threading.Thread(target=client) for _ in xrange(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    timings.sort()
+    return {'requests': requests,
+            'errors': errors[0],
+            'requests_per_sec': requests / elapsed,
+            'p50_ms': percentile(timings, 50),
+            'p95_ms': percentile(timings, 95),
+            'p99_ms': percentile(timings, 99),
+            'datastore_rpcs': sum(c.get('datastore_v3', 0)
+                                  for c in rpcs) / float(requests),
+            'memcache_rpcs': sum(c.get('memcache', 0)
+                                 for c in rpcs) / float(requests)}
+
+def main():
+    """Run the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--posts', type=int, default=50)
+    parser.add_argument('--comments', type=int, default=5,
+                        help='comments per post')
+    parser.add_argument('--likes', type=int, default=5,
+                        help='likes per post')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per route')
+    parser.add_argument('--clients', type=int, default=4,
+                        help='concurrent clients')
+    parser.add_argument('--routes', default='',
+                        help='comma separated routes to run (default all)')
+    parser.add_argument('--no-page-cache', action='store_true',
+                        help='bypass the page cache middleware')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='random seed, for repeatable runs')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    parser.add_argument('-o', '--output',
+                        help='also write the JSON results to this file')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    bed = setup_testbed()
+    try:
+        import main as app_main
+        app = app_main.application if args.no_page_cache else app_main.app
+
+        accounts, post_ids = seed(args.users, args.posts, args.comments,
+                                  args.likes)
+        available = routes(accounts, post_ids)
+        names = [name for name in args.routes.split(',') if name]
+        for name in names:
+            if name not in available:
+                parser.error('unknown route %s, pick from %s' % (
+                    name, ', '.join(sorted(available))))
+
+        results = {}
+        for name in names or sorted(available):
+            results[name] = run_route(app, available[name], args.requests,
+                                      args.clients)
+    finally:
+        bed.deactivate()
+
+    report = {'config': dict((key, value) for key, value
+                             in vars(args).items()
+                             if key not in ('json', 'output')),
+              'routes': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.json:
+        print json.dumps(report, indent=2, sort_keys=True)
+        return
+
+    print '%-12s %8s %8s %8s %8s %8s %6s %6s' % (
+        'route', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors',
+        'ds', 'mc')
+    for name in sorted(results):
+        r = results[name]
+        print '%-12s %8.1f %8.1f %8.1f %8.1f %8d %6.1f %6.1f' % (
+            name, r['requests_per_sec'], r['p50_ms'], r['p95_ms'],
+            r['p99_ms'], r['errors'], r['datastore_rpcs'],
+            r['memcache_rpcs'])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Password hashing benchmark
+
+Times checking a password (what Login.post pays per attempt) for a range
+of hasher costs, and reports the highest cost that keeps the 95th
+percentile within a per-login CPU budget. Use it to pick
+settings.PW_HASH_COST.
+
+Run from the project root with the App Engine SDK on PYTHONPATH, on a
+machine comparable to the instance class the app is deployed on:
+`python bench/password_hash.py --budget-ms 50`
+
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import handler
+
+def time_logins(hasher, cost, rounds):
+    """Time rounds password checks against a hash of the given cost,
+    returning the sorted timings in milliseconds
+    """
+    h = handler.make_pw_hash('bench', 'password', hasher=hasher, cost=cost)
+    timings = []
+    for _ in xrange(rounds):
+        start = time.time()
+        handler.valid_password('bench', 'password', h)
+        timings.append((time.time() - start) * 1000)
+    return sorted(timings)
+
+def percentile(timings, pct):
+    """Get a percentile of sorted timings"""
+    return timings[min(len(timings) - 1, int(len(timings) * pct / 100.0))]
+
+def main():
+    """Run the benchmark"""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hasher', default='pbkdf2_sha256',
+                        choices=sorted(handler.PW_HASHERS))
+    parser.add_argument('--costs', default='5000,10000,20000,50000,100000',
+                        help='comma separated costs to try')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--budget-ms', type=float, default=50.0,
+                        help='p95 login latency budget for hashing')
+    parser.add_argument('--json', action='store_true',
+                        help='print results as JSON')
+    args = parser.parse_args()
+
+    results = []
+    for cost in [int(cost) for cost in args.costs.split(',')]:
+        timings = time_logins(args.hasher, cost, args.rounds)
+        results.append({'hasher': args.hasher,
+                        'cost': cost,
+                        'p50_ms': percentile(timings, 50),
+                        'p95_ms': percentile(timings, 95)})
+
+    within = [r['cost'] for r in results if r['p95_ms'] <= args.budget_ms]
+    recommended = max(within) if within else None
+
+    if args.json:
+        print json.dumps({'results': results, 'budget_ms': args.budget_ms,
+                          'recommended_cost': recommended}, indent=2)
+        return
+
+    print '%-15s %10s %10s %10s' % ('hasher', 'cost', 'p50 ms', 'p95 ms')
+    for r in results:
+        print '%-15s %10d %10.1f %10.1f' % (r['hasher'], r['cost'],
+                                           r['p50_ms'], r['p95_ms'])
+    if recommended:
+        print '\nHighest cost within %.0f ms: %d' % (args.budget_ms,
+                                                    recommended)
+    else:
+        print '\nNo cost tried fits within %.0f ms' % args.budget_ms
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+"""Blog Admin
+
+Admin-only maintenance handlers for the blog, including:
+* data migrations, run in batches on the task queue
+* background tasks, such as deleting a deleted post's thread or applying
+  queued writes
+
+Routes for this module live under /admin/ and are restricted to app
+admins in app.yaml.
+
+"""
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+import counter
+import settings as s
+from handler import Handler, User, index_user_name
+from blog_model import *
+from blog_queue import apply_writes, LEASE_SECONDS
+from blog_search import index_post, index_comment
+
+BATCH_SIZE = 50
+DELETE_BATCH_SIZE = 500
+
+class MigrationHandler(Handler):
+    """Generic handler for a batched migration
+
+    A GET from an admin starts the migration. Each POST (a task) migrates
+    one batch of entities and enqueues the next batch.
+    """
+    keys_only = False
+
+    def query(self):
+        """Query for the entities to migrate"""
+        return Post.query()
+
+    def migrate(self, entity):
+        """Migrate a single entity"""
+        raise NotImplementedError
+
+    def get(self):
+        """Start the migration"""
+        taskqueue.add(url=self.request.path)
+        self.write('Migration started.')
+
+    def post(self):
+        """Migrate one batch of entities"""
+        cursor = self.request.get('cursor')
+        if cursor:
+            cursor = Cursor(urlsafe=cursor)
+        entities, cursor, more = self.query().fetch_page(
+            BATCH_SIZE, start_cursor=cursor or None, keys_only=self.keys_only)
+        for entity in entities:
+            self.migrate(entity)
+
+        if more:
+            taskqueue.add(url=self.request.path,
+                          params={'cursor': cursor.urlsafe()})
+
+class MigrateLikes(MigrationHandler):
+    """Re-key legacy likes and rebuild each post's like counter
+
+    Works in any layout; /admin/migrate-layout keeps the new keys.
+    """
+    keys_only = True
+
+    def migrate(self, key):
+        """Migrate a single post's likes"""
+        migrate_post_likes(key)
+
+class MigrateLayout(MigrationHandler):
+    """Move posts, with their comments and likes, into an entity group
+    per post
+    """
+    keys_only = True
+
+    def get(self):
+        """Start the migration, if posts can be found while it runs"""
+        if s.BLOG_LAYOUT != 'migrating':
+            self.write("Set BLOG_LAYOUT = 'migrating' and deploy first.")
+            return
+        MigrationHandler.get(self)
+
+    def query(self):
+        """Query for all posts, so that a post whose move failed part way
+        is finished too
+        """
+        return Post.query()
+
+    def migrate(self, key):
+        """Move a single post"""
+        migrate_post_layout(key.id())
+
+class MigrateUserNames(MigrationHandler):
+    """Add users registered before the name index to it"""
+    def query(self):
+        """Query for all users"""
+        return User.query()
+
+    def migrate(self, user):
+        """Index a single user's name"""
+        index_user_name(user)
+
+class MigrateCommentCounts(MigrationHandler):
+    """Count the comments of posts written before they were counted"""
+    keys_only = True
+
+    def migrate(self, key):
+        """Count a single post's comments"""
+        post_id = key.id()
+        count = comment_query(post_id).count()
+
+        def txn():
+            post = key.get()
+            post.comment_cnt = count
+            post.put()
+
+        ndb.transaction(txn)
+
+class MigrateUserCounts(MigrationHandler):
+    """Count the posts and comments of users registered before they were
+    counted
+    """
+    def query(self):
+        """Query for all users"""
+        return User.query()
+
+    def migrate(self, user):
+        """Count a single user's posts and comments
+
+        Meant for a one-off backfill: posts and comments the user writes
+        while it runs may be missed by the counts.
+        """
+        counter.reset(author_post_counter(user.name),
+                      Post.query(Post.author == user.name).count())
+        counter.reset(author_comment_counter(user.name),
+                      Comment.query(Comment.author == user.name).count())
+
+class MigrateSearchIndex(MigrationHandler):
+    """Add posts and comments written before search to the search index"""
+    def migrate(self, post):
+        """Index a single post and its comments"""
+        index_post(post)
+        for comment in comment_query(post.key.id()):
+            index_comment(comment)
+
+class MigrateContentHtml(MigrationHandler):
+    """Render the content of posts and comments saved before it was
+    rendered on save
+    """
+    def migrate(self, post):
+        """Render a single post and its comments"""
+        render_content(post)
+        for comment in comment_query(post.key.id()):
+            render_content(comment)
+
+class DeleteThread(Handler):
+    """Task deleting a deleted post's comments and likes in batches"""
+    def post(self):
+        """Delete one batch, and enqueue the next if there is more"""
+        post_id = self.request.get('post_id')
+        more, authors = delete_thread_batch(post_id, DELETE_BATCH_SIZE)
+        count_author_comments(authors, -1)
+        if more:
+            taskqueue.add(url=self.request.path, params={'post_id': post_id})
+
+class ApplyWrites(Handler):
+    """Task applying a post's queued likes and comments, see blog_queue"""
+    def post(self):
+        """Apply one batch, and enqueue the next if there is more"""
+        post_id = self.request.get('post_id')
+        leased, more = apply_writes(post_id)
+        if more:
+            taskqueue.add(url=self.request.path, params={'post_id': post_id})
+        elif not leased and not self.request.get('recheck'):
+            # writes leased by a try that died are invisible until their
+            # lease expires, so look once more after that
+            taskqueue.add(url=self.request.path,
+                          params={'post_id': post_id, 'recheck': 1},
+                          countdown=LEASE_SECONDS + 1)
@@ -4,61 +4,118 @@ Controls backend functionality of the blog, including:
 * create/edit/delete blog posts
 * create/edit/delete blog post comments
 * like and unlike blog posts
+* list an author's blog posts
+* search blog posts and comments
 
 """
 
-from google.appengine.ext import db
+import datetime
+import urllib
 
-from handler import Handler
+from google.appengine.api import search
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import counter
+import settings as s
+from cache import flush_pages
+from handler import Handler, user_by_name
 from blog_model import *
+from blog_queue import enqueue_like, enqueue_comment
+from blog_search import index_post, index_comment, unindex, post_doc_id, \
+    comment_doc_id, search_page
 
 class BlogHandler(Handler):
     """Generic web handler for the blog"""
-    def render_post(self):
-        """Render a blog post in HTML"""
-        self._render_text = self.content.replace('\n', '<br>')
-        return render_str("blog-post.html", p=self)
+    def thread_not_modified(self, posts, comments=(), *parts):
+        """Answer a conditional GET for a page showing posts (with likes
+        loaded) and comments, see Handler.not_modified
+
+        Removed posts and comments change the ETag but can't move
+        Last-Modified forward, so only If-None-Match notices them.
+        """
+        dates = [post.last_modified for post in posts]
+        dates.extend(post.likes_modified for post in posts
+                     if post.likes_modified)
+        dates.extend(post.comments_modified for post in posts
+                     if post.comments_modified)
+        dates.extend(comment.last_modified for comment in comments)
+        parts += tuple((post.key.id(), post.last_modified, post.like_cnt,
+                        post.liked, post.comment_cnt) for post in posts)
+        parts += tuple((comment.key.id(), comment.last_modified)
+                       for comment in comments)
+        return self.not_modified(max(dates or [None]), *parts)
 
 class BlogFront(BlogHandler):
     """Web hanlder for blog front page"""
     def get(self):
         """Get blog front page"""
-        posts = Post.all().order('-created')
-        out_posts = []
-        for post in posts:
-            likes = Liked.all().filter(' post_id =', str(post.key().id()))
-            out_post = post
-            out_post.liked = False
-            out_post.like_cnt = 0
-            for like in likes:
-                out_post.like_cnt += 1
-                if self.user and like.author == self.user.name:
-                    out_post.liked = True
-            out_posts.append(out_post)
-        self.render("blog-front.html", posts=out_posts)
+        posts, prev_cursor, next_cursor = fetch_page(
+            Post.query().order(-Post.created),
+            Post.query().order(Post.created),
+            s.POSTS_PER_PAGE, cursor=self.request.get('cursor'),
+            before=self.request.get('before'))
+        load_likes(posts, self.user)
+        if self.thread_not_modified(posts, (), prev_cursor, next_cursor):
+            return
+        self.render("blog-front.html", posts=posts, prev_cursor=prev_cursor,
+                    next_cursor=next_cursor)
 
 class PostPage(BlogHandler):
     """Web hanlder for individual blog post"""
     def get(self, post_id):
         """Get a single blog post"""
-        key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-        post = db.get(key)
+        # start every fetch before waiting on any of them
+        post_future = post_key(post_id).get_async()
+        comments_future = fetch_page_async(
+            comment_query(post_id).order(Comment.created),
+            comment_query(post_id).order(-Comment.created),
+            s.COMMENTS_PER_PAGE, cursor=self.request.get('cursor'),
+            before=self.request.get('before'))
+        set_likes = load_likes_async([post_id], self.user)
+
+        post = post_future.get_result()
 
         if not post:
             self.render("404.html")
             return
 
-        comments = Comment.all().filter(' post_id =', post_id).order('created')
-        likes = Liked.all().filter(' post_id =', post_id)
+        set_likes([post])
+        comments, prev_cursor, next_cursor = comments_future.get_result()
 
-        post.liked = False
-        post.like_cnt = 0
-        for like in likes:
-            post.like_cnt += 1
-            if self.user and like.author == self.user.name:
-                post.liked = True
+        if self.thread_not_modified([post], comments, prev_cursor,
+                                    next_cursor):
+            return
+        self.render("blog-permalink.html", post=post, comments=comments,
+                    prev_cursor=prev_cursor, next_cursor=next_cursor)
+
+class AuthorPage(BlogHandler):
+    """Web handler for an author's posts"""
+    def get(self, name):
+        """Get a page of an author's posts, newest first"""
+        posts_future = fetch_page_async(
+            Post.query(Post.author == name).order(-Post.created),
+            Post.query(Post.author == name).order(Post.created),
+            s.POSTS_PER_PAGE, cursor=self.request.get('cursor'),
+            before=self.request.get('before'))
+        author = user_by_name(name)
+
+        if not author:
+            self.render("404.html")
+            return
 
-        self.render("blog-permalink.html", post=post, comments=comments)
+        counters = counter.get_counters([author_post_counter(name),
+                                         author_comment_counter(name)])
+        post_cnt = counters[author_post_counter(name)][0]
+        comment_cnt = counters[author_comment_counter(name)][0]
+        posts, prev_cursor, next_cursor = posts_future.get_result()
+        load_likes(posts, self.user)
+        if self.thread_not_modified(posts, (), prev_cursor, next_cursor,
+                                    post_cnt, comment_cnt):
+            return
+        self.render("blog-author.html", author=author, posts=posts,
+                    post_cnt=post_cnt, comment_cnt=comment_cnt,
+                    prev_cursor=prev_cursor, next_cursor=next_cursor)
 
 class NewPost(BlogHandler):
     """Web hanlder for creating a new blog post"""
@@ -80,10 +137,19 @@ class NewPost(BlogHandler):
         content = self.request.get('content')
 
         if subject and content:
-            post = Post(parent=blog_key(), author=self.user.name,
+            post = Post(parent=post_parent(), author=self.user.name,
                         subject=subject, content=content)
-            post.put()
-            self.redirect('/blog/%s' % str(post.key().id()))
+
+            def txn():
+                """Add the post and count it for its author"""
+                post.put()
+                counter.add(author_post_counter(self.user.name), 1)
+
+            ndb.transaction(txn, xg=True)
+            counter.update_cache(author_post_counter(self.user.name), 1)
+            index_post(post)
+            flush_pages()
+            self.redirect('/blog/%s' % str(post.key.id()))
         else:
             error = "subject and content, please!"
             self.render("blog-newpost.html", subject=subject, content=content, error=error)
@@ -96,8 +162,7 @@ class EditPost(BlogHandler):
             self.redirect('/login')
             return
 
-        key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-        post = db.get(key)
+        post = post_key(post_id).get()
 
         if not post:
             self.render("404.html")
@@ -115,8 +180,7 @@ class EditPost(BlogHandler):
             self.redirect('/login')
             return
 
-        key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-        post = db.get(key)
+        post = post_key(post_id).get()
 
         if not post:
             self.render("404.html")
@@ -130,10 +194,14 @@ class EditPost(BlogHandler):
         content = self.request.get('content')
 
         if subject and content:
+            post.flush_render_cache()
             post.subject = subject
             post.content = content
+            post.last_modified = datetime.datetime.utcnow()
             post.put()
-            self.redirect('/blog/%s' % str(post.key().id()))
+            index_post(post)
+            flush_pages()
+            self.redirect('/blog/%s' % str(post.key.id()))
         else:
             error = "subject and content, please!"
             self.render("blog-editpost.html", subject=subject, content=content,
@@ -147,8 +215,7 @@ class DeletePost(BlogHandler):
             self.redirect('/login')
             return
 
-        key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-        post = db.get(key)
+        post = post_key(post_id).get()
 
         if not post:
             self.render("404.html")
@@ -166,8 +233,7 @@ class DeletePost(BlogHandler):
             self.redirect('/login')
             return
 
-        key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-        post = db.get(key)
+        post = post_key(post_id).get()
 
         if not post:
             self.render("404.html")
@@ -177,17 +243,25 @@ class DeletePost(BlogHandler):
             self.redirect("/blog/%s" % str(post_id))
             return
 
-        comments = Comment.all().filter(' post_id =', post_id)
-        likes = Liked.all().filter(' post_id =', post_id)
-
         subject = self.request.get('subject')
 
         if subject and subject == post.subject:
-            post.delete()
-            for comment in comments:
-                comment.delete()
-            for like in likes:
-                like.delete()
+            post.flush_render_cache()
+
+            def txn():
+                """Delete the post and uncount it for its author, leaving
+                its thread to a task
+                """
+                post.key.delete()
+                counter.add(author_post_counter(post.author), -1)
+                taskqueue.add(url='/admin/delete-thread',
+                              params={'post_id': post_id}, transactional=True)
+
+            ndb.transaction(txn, xg=True)
+            counter.update_cache(author_post_counter(post.author), -1)
+            # the thread's comments are unindexed as the task deletes them
+            unindex([post_doc_id(post_id)])
+            flush_pages()
             self.redirect("/blog")
         elif subject and subject != post.subject:
             error = "Entered subject does not match the post's subject."
@@ -206,15 +280,10 @@ class Like(BlogHandler):
             self.redirect("/login")
             return
 
-        key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-        post = db.get(key)
-
-        liked = Liked.all().filter(' post_id =', str(post_id))
-        liked = liked.filter(' author =', self.user.name).get()
-        if not liked and post.author != self.user.name:
-            liked = Liked(parent=blog_key(), post_id=str(post_id),
-                          author=self.user.name)
-            liked.put()
+        if s.WRITE_BEHIND:
+            enqueue_like(post_id, self.user.name)
+        else:
+            like_post(post_id, self.user.name)
 
         self.redirect("/blog/%s" % str(post_id))
 
@@ -226,10 +295,10 @@ class UnLike(BlogHandler):
             self.redirect("/login")
             return
 
-        liked = Liked.all().filter(' post_id =', str(post_id))
-        liked = liked.filter(' author =', self.user.name).get()
-        if liked:
-            liked.delete()
+        if s.WRITE_BEHIND:
+            enqueue_like(post_id, self.user.name, like=False)
+        else:
+            unlike_post(post_id, self.user.name)
 
         self.redirect("/blog/%s" % str(post_id))
 
@@ -241,13 +310,15 @@ class NewComment(BlogHandler):
             self.redirect('/login')
             return
 
-        post_key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-        post = db.get(post_key)
+        post_future = post_key(post_id).get_async()
+        set_likes = load_likes_async([post_id], self.user)
+        post = post_future.get_result()
 
         if not post:
             self.render("404.html")
             return
 
+        set_likes([post])
         self.render("blog-newcomment.html", post=post)
 
     def post(self, post_id):
@@ -256,8 +327,7 @@ class NewComment(BlogHandler):
             self.redirect('/login')
             return
 
-        post_key = db.Key.from_path('Post', int(post_id), parent=blog_key())
-        post = db.get(post_key)
+        post = post_key(post_id).get()
 
         if not post:
             self.render("404.html")
@@ -265,126 +335,147 @@ class NewComment(BlogHandler):
 
         content = self.request.get('content')
 
-        if content:
-            comment = Comment(parent=blog_key(), post_id=post_id,
+        if content and s.WRITE_BEHIND:
+            enqueue_comment(post_id, self.user.name, content)
+            self.redirect('/blog/%s' % post_id)
+        elif content:
+            comment = Comment(parent=thread_key(post_id), post_id=post_id,
                               author=self.user.name, content=content)
-            comment.put()
+
+            def txn():
+                """Add the comment and count it on the post and for its
+                author
+                """
+                comment.put()
+                count_comments(post_id, 1)
+                counter.add(author_comment_counter(self.user.name), 1)
+
+            ndb.transaction(txn, xg=True)
+            counter.update_cache(author_comment_counter(self.user.name), 1)
+            index_comment(comment)
+            flush_pages()
             self.redirect('/blog/%s' % post_id)
         else:
             error = "Comment cannot be empty"
+            load_likes([post], self.user)
             self.render("blog-newcomment.html", content=content, post=post,
                         error=error)
 
 class EditComment(BlogHandler):
     """Web handler for editing an existing comment"""
-    def get(self, comment_id):
+    def get(self, post_id, comment_id):
         """Get a web page for editing an existing comment"""
         if not self.user:
             self.redirect('/login')
             return
 
-        key = db.Key.from_path('Comment', int(comment_id), parent=blog_key())
-        comment = db.get(key)
+        futures = ndb.get_multi_async([comment_key(post_id, comment_id),
+                                       post_key(post_id)])
+        set_likes = load_likes_async([post_id], self.user)
+        comment, post = [future.get_result() for future in futures]
 
-        if not comment:
+        if not comment or not post or comment.post_id != post_id:
             self.render("404.html")
             return
 
         if not self.user.name == comment.author:
-            self.redirect("/blog/%s" % str(comment.post_id))
+            self.redirect("/blog/%s" % post_id)
             return
 
-        post_key = db.Key.from_path('Post', int(comment.post_id),
-                                    parent=blog_key())
-        post = db.get(post_key)
-
+        set_likes([post])
         self.render("blog-editcomment.html", content=comment.content,
                         post=post)
 
-    def post(self, comment_id):
+    def post(self, post_id, comment_id):
         """Post (i.e. publish) an edit to an existing comment"""
         if not self.user:
             self.redirect('/login')
             return
 
-        key = db.Key.from_path('Comment', int(comment_id), parent=blog_key())
-        comment = db.get(key)
+        comment, post = ndb.get_multi([comment_key(post_id, comment_id),
+                                       post_key(post_id)])
 
-        if not comment:
+        if not comment or not post or comment.post_id != post_id:
             self.render("404.html")
             return
 
         if not self.user.name == comment.author:
-            self.redirect("/blog/%s" % str(comment.post_id))
+            self.redirect("/blog/%s" % post_id)
             return
 
-        post_key = db.Key.from_path('Post', int(comment.post_id),
-                                    parent=blog_key())
-        post = db.get(post_key)
-
         content = self.request.get('content')
 
         if content:
+            comment.flush_render_cache()
             comment.content = content
+            comment.last_modified = datetime.datetime.utcnow()
             comment.put()
-            self.redirect('/blog/%s' % comment.post_id)
+            index_comment(comment)
+            flush_pages()
+            self.redirect('/blog/%s' % post_id)
         else:
             error = "Comment cannot be empty"
+            load_likes([post], self.user)
             self.render("blog-editcomment.html", content=content, post=post,
                         error=error)
 
 class DeleteComment(BlogHandler):
     """Web hanlder for deleting an existing blog post comment"""
-    def get(self, comment_id):
+    def get(self, post_id, comment_id):
         """Get a webpage for deleting an existing blog post comment"""
         if not self.user:
             self.redirect('/login')
             return
 
-        key = db.Key.from_path('Comment', int(comment_id), parent=blog_key())
-        comment = db.get(key)
+        comment, post = ndb.get_multi([comment_key(post_id, comment_id),
+                                       post_key(post_id)])
 
-        if not comment:
+        if not comment or not post or comment.post_id != post_id:
             self.render("404.html")
             return
 
         if not self.user.name == comment.author:
-            self.redirect("/blog/%s" % str(comment.post_id))
+            self.redirect("/blog/%s" % post_id)
             return
 
-        post_key = db.Key.from_path('Post', int(comment.post_id),
-                                    parent=blog_key())
-        post = db.get(post_key)
-
         self.render("blog-deletecomment.html", content=comment.content,
                         post=post)
 
-    def post(self, comment_id):
+    def post(self, post_id, comment_id):
         """Post (i.e. publish) the deletion of an existng blog post comment"""
         if not self.user:
             self.redirect('/login')
             return
 
-        key = db.Key.from_path('Comment', int(comment_id), parent=blog_key())
-        comment = db.get(key)
+        comment, post = ndb.get_multi([comment_key(post_id, comment_id),
+                                       post_key(post_id)])
 
-        if not comment:
+        if not comment or not post or comment.post_id != post_id:
             self.render("404.html")
             return
 
         if not self.user.name == comment.author:
-            self.redirect("/blog/%s" % str(comment.post_id))
+            self.redirect("/blog/%s" % post_id)
             return
 
-        post_key = db.Key.from_path('Post', int(comment.post_id),
-                                    parent=blog_key())
-        post = db.get(post_key)
-
         content = self.request.get('content')
 
         if content and content == comment.content:
-            comment.delete()
-            self.redirect("/blog/%s" % str(comment.post_id))
+            comment.flush_render_cache()
+
+            def txn():
+                """Delete the comment and uncount it on the post and for
+                its author
+                """
+                comment.key.delete()
+                count_comments(post_id, -1)
+                counter.add(author_comment_counter(comment.author), -1)
+
+            ndb.transaction(txn, xg=True)
+            counter.update_cache(author_comment_counter(comment.author), -1)
+            unindex([comment_doc_id(post_id, comment_id)])
+            flush_pages()
+            self.redirect("/blog/%s" % post_id)
         elif content and content != comment.content:
             error = "Entered content does not match the comment's content."
             self.render("blog-deletecomment.html", content=comment.content,
@@ -393,3 +484,22 @@ class DeleteComment(BlogHandler):
             error = "Please enter the comment's content above to delete this comment."
             self.render("blog-deletecomment.html", content=comment.content,
                         post=post, error=error)
+
+class Search(BlogHandler):
+    """Web handler for searching blog posts and comments"""
+    def get(self):
+        """Get a page of search results"""
+        query = self.request.get('q').strip()
+        results, next_url, error = [], None, None
+        if query:
+            try:
+                results, next_cursor = search_page(
+                    query, cursor=self.request.get('cursor'))
+            except (search.Error, ValueError):
+                error = "Sorry, that search couldn't be understood."
+            else:
+                if next_cursor:
+                    next_url = '/blog/search?' + urllib.urlencode(
+                        {'q': query.encode('utf-8'), 'cursor': next_cursor})
+        self.render("blog-search.html", q=query, results=results,
+                    next_url=next_url, error=error)
@@ -4,43 +4,592 @@ Creates all data models in Google's Datastore.
 Any model kinds necessary for the blog are created below.
 """
 
+import collections
+import datetime
+import hashlib
+import os
+
+from google.appengine.api import datastore
+from google.appengine.api import datastore_errors
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import db
+from google.appengine.ext import ndb
 
+import counter
 import settings as s
+from blog_render import render_text
+from blog_search import unindex, comment_doc_id
+from cache import FragmentCache
+
+# per app version, as the cached HTML depends on the templates
+render_cache = FragmentCache(
+    'render-%s' % os.environ.get('CURRENT_VERSION_ID', ''),
+    s.RENDER_CACHE_SIZE)
 
 def blog_key(name='default'):
     """Grab parent key for blog database"""
-    return db.Key.from_path('blogs', name)
+    return ndb.Key('blogs', name)
+
+def post_parent():
+    """Grab parent key for new posts
+
+    In the legacy 'blog' layout every entity lives in blog_key()'s entity
+    group. In the 'post' layout each post is the root of its own entity
+    group, holding its comments and likes. While 'migrating' new posts
+    are written in the 'post' layout.
+    """
+    if s.BLOG_LAYOUT == 'blog':
+        return blog_key()
+    return None
+
+@ndb.non_transactional
+def post_layout(post_id):
+    """Layout a post is stored in, 'blog' or 'post'
+
+    While settings.BLOG_LAYOUT is 'migrating', posts already moved by
+    migrate_post_layout (or written since) are in the 'post' layout and
+    the rest in 'blog', which takes a get (see load_layouts).
+    """
+    if s.BLOG_LAYOUT != 'migrating':
+        return s.BLOG_LAYOUT
+    if ndb.Key('Post', int(post_id)).get():
+        return 'post'
+    return 'blog'
+
+def load_layouts(post_ids):
+    """Look up the layouts of several posts in one batch get, for
+    post_layout to find in the context cache
+    """
+    if s.BLOG_LAYOUT == 'migrating':
+        ndb.get_multi([ndb.Key('Post', int(post_id)) for post_id in post_ids])
+
+def post_key(post_id):
+    """Get Google Datastore key for a post"""
+    if post_layout(post_id) == 'blog':
+        return ndb.Key('Post', int(post_id), parent=blog_key())
+    return ndb.Key('Post', int(post_id))
+
+def thread_key(post_id):
+    """Grab parent key for a post's comments and likes"""
+    if post_layout(post_id) == 'blog':
+        return blog_key()
+    return post_key(post_id)
+
+def comment_query(post_id):
+    """Strongly consistent query for a post's comments
 
-class Post(db.Model):
+    In the 'post' layout a post's comments are exactly its descendants,
+    so a plain ancestor query finds them. The legacy 'blog' layout also
+    needs to filter on post_id.
+    """
+    if post_layout(post_id) == 'blog':
+        return Comment.query(Comment.post_id == str(post_id),
+                             ancestor=blog_key())
+    return Comment.query(ancestor=post_key(post_id))
+
+def count_comments(post_id, delta):
+    """Add delta to a post's comment count
+
+    Call it in the transaction adding or deleting the comments; a post
+    and its comments share an entity group.
+    """
+    post = post_key(post_id).get()
+    if post:
+        post.comment_cnt += delta
+        post.comments_modified = datetime.datetime.utcnow()
+        post.put()
+
+def comment_key(post_id, comment_id):
+    """Get Google Datastore key for a comment on a post"""
+    return ndb.Key('Comment', int(comment_id), parent=thread_key(post_id))
+
+def _render_cache_key(entity):
+    """Key for this version of a post or comment in the render cache
+
+    Covers content_html as well as last_modified, which stays unchanged
+    when content_html is first stored (see render_content).
+    """
+    html = hashlib.sha1((entity.content_html or u'').encode('utf-8'))
+    return '%s:%s:%s' % (entity.key.urlsafe(),
+                         entity.last_modified.isoformat(),
+                         html.hexdigest())
+
+class Post(ndb.Model):
     """Blog post model, for storing posts"""
-    author = db.StringProperty(required=True)
-    subject = db.StringProperty(required=True)
-    content = db.TextProperty(required=True)
-    created = db.DateTimeProperty(auto_now_add=True)
-    last_modified = db.DateTimeProperty(auto_now=True)
+    author = ndb.StringProperty(required=True)
+    subject = ndb.StringProperty(required=True)
+    content = ndb.TextProperty(required=True)
+    # content rendered by blog_render, kept up to date on every put
+    content_html = ndb.TextProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    # not auto_now: only an edit should change it, see EditPost
+    last_modified = ndb.DateTimeProperty(auto_now_add=True)
+    # kept up to date with the post's comments, see count_comments
+    comment_cnt = ndb.IntegerProperty(default=0)
+    comments_modified = ndb.DateTimeProperty()
+
+    def _pre_put_hook(self):
+        """Render content to HTML before saving"""
+        self.content_html = render_text(self.content)
+
+    def render_cache_key(self):
+        """Key for this version of the post in the render cache"""
+        return _render_cache_key(self)
+
+    def render_body(self):
+        """Render the user-independent part of the post using
+        blog-post-body.html, caching the result
+        """
+        body = render_cache.get(self.render_cache_key())
+        if body is None:
+            body = s.jinja_env.get_template("blog-post-body.html").render(
+                p=self)
+            render_cache.set(self.render_cache_key(), body)
+        return body
+
+    def flush_render_cache(self):
+        """Drop this version of the post from the render cache"""
+        render_cache.delete(self.render_cache_key())
 
     def render(self, user):
         """Render blog post in HTML using blog-post.html"""
-        self._render_text = self.content.replace('\n', '<br>')
-        return s.jinja_env.get_template("blog-post.html").render(p=self,
-                                                                 user=user)
+        return s.jinja_env.get_template("blog-post.html").render(
+            p=self, user=user, body=self.render_body())
 
-class Comment(db.Model):
+class Comment(ndb.Model):
     """Blog post comment model, for storing comments"""
-    post_id = db.StringProperty(required=True)
-    author = db.StringProperty(required=True)
-    content = db.TextProperty(required=True)
-    created = db.DateTimeProperty(auto_now_add=True)
-    last_modified = db.DateTimeProperty(auto_now=True)
+    post_id = ndb.StringProperty(required=True)
+    author = ndb.StringProperty(required=True)
+    content = ndb.TextProperty(required=True)
+    # content rendered by blog_render, kept up to date on every put
+    content_html = ndb.TextProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    # not auto_now: only an edit should change it, see EditComment
+    last_modified = ndb.DateTimeProperty(auto_now_add=True)
+
+    def _pre_put_hook(self):
+        """Render content to HTML before saving"""
+        self.content_html = render_text(self.content)
+
+    def render_cache_key(self):
+        """Key for this version of the comment in the render cache"""
+        return _render_cache_key(self)
+
+    def render_body(self):
+        """Render the user-independent part of the comment using
+        blog-comment-body.html, caching the result
+        """
+        body = render_cache.get(self.render_cache_key())
+        if body is None:
+            body = s.jinja_env.get_template("blog-comment-body.html").render(
+                c=self)
+            render_cache.set(self.render_cache_key(), body)
+        return body
+
+    def flush_render_cache(self):
+        """Drop this version of the comment from the render cache"""
+        render_cache.delete(self.render_cache_key())
 
     def render(self, user):
         """Render blog post comment in HTML using blog-comment.html"""
-        self._render_text = self.content.replace('\n', '<br>')
-        return s.jinja_env.get_template("blog-comment.html").render(c=self,
-                                                                    user=user)
-
-class Liked(db.Model):
-    """Blog post like model, for storing whether someone likes a blog post"""
-    post_id = db.StringProperty(required=True)
-    author = db.StringProperty(required=True)
+        return s.jinja_env.get_template("blog-comment.html").render(
+            c=self, user=user, body=self.render_body())
+
+def render_content(entity):
+    """Store rendered HTML on a post or comment saved before content_html
+    existed
+    """
+    entity.flush_render_cache()
+    entity.put()
+
+class Liked(ndb.Model):
+    """Blog post like model, for storing whether someone likes a blog post
+
+    Keyed by post id and author (see liked_key) so a user's likes can be
+    looked up with a batch get instead of a query.
+    """
+    post_id = ndb.StringProperty(required=True)
+    author = ndb.StringProperty(required=True)
+
+@ndb.tasklet
+def fetch_page_async(query, reverse_query, page_size, cursor=None,
+                     before=None):
+    """Fetch one page of results using datastore query cursors
+
+    query and reverse_query must be the same query in opposite sort
+    orders. A page starts at cursor, or ends at before when paging
+    backwards. Returns a future for (results, prev_cursor, next_cursor);
+    either cursor is None when there is no page in that direction.
+    """
+    try:
+        if before:
+            start = Cursor(urlsafe=before).reversed()
+            results, prev_cursor, more = yield reverse_query.fetch_page_async(
+                page_size, start_cursor=start)
+            # short of a full page means we reached the first page, which
+            # is shown in full below
+            if len(results) == page_size:
+                results.reverse()
+                if more:
+                    prev_cursor = prev_cursor.reversed().urlsafe()
+                else:
+                    prev_cursor = None
+                raise ndb.Return((results, prev_cursor, before))
+        elif cursor:
+            results, next_cursor, more = yield query.fetch_page_async(
+                page_size, start_cursor=Cursor(urlsafe=cursor))
+            if more:
+                next_cursor = next_cursor.urlsafe()
+            else:
+                next_cursor = None
+            raise ndb.Return((results, cursor, next_cursor))
+    except (datastore_errors.BadValueError,
+            datastore_errors.BadRequestError):
+        # malformed cursor, or one from a different query
+        pass
+
+    results, next_cursor, more = yield query.fetch_page_async(page_size)
+    if more:
+        next_cursor = next_cursor.urlsafe()
+    else:
+        next_cursor = None
+    raise ndb.Return((results, None, next_cursor))
+
+def fetch_page(query, reverse_query, page_size, cursor=None, before=None):
+    """Fetch one page of results, see fetch_page_async"""
+    return fetch_page_async(query, reverse_query, page_size, cursor,
+                            before).get_result()
+
+def liked_key(post_id, author):
+    """Get Google Datastore key for author's like of a post
+
+    In the 'post' layout likes are root entities rather than children of
+    the post, so that likes on a hot post don't contend for its entity
+    group.
+    """
+    parent = blog_key() if post_layout(post_id) == 'blog' else None
+    return ndb.Key('Liked', '%s:%s' % (post_id, author), parent=parent)
+
+def like_counter(post_id):
+    """Name of the sharded counter holding a post's like count"""
+    return 'likes-%s' % post_id
+
+def author_post_counter(author):
+    """Name of the sharded counter holding an author's post count"""
+    return 'author-posts-%s' % author
+
+def author_comment_counter(author):
+    """Name of the sharded counter holding an author's comment count"""
+    return 'author-comments-%s' % author
+
+def count_author_comments(authors, delta):
+    """Add delta to the comment count of each author, once per
+    occurrence, outside any transaction (e.g. in a task)
+    """
+    for author, count in collections.Counter(authors).items():
+        counter.add(author_comment_counter(author), delta * count)
+        counter.update_cache(author_comment_counter(author), delta * count)
+
+def load_likes_async(post_ids, user):
+    """Start loading like counts, and the logged in user's likes, for
+    posts
+
+    Returns a function that, given the posts in the same order, sets
+    like_cnt, likes_modified (when the like count last changed, or None)
+    and liked on each.
+    """
+    post_ids = [str(post_id) for post_id in post_ids]
+    liked_futures = []
+    if user:
+        load_layouts(post_ids)
+        liked_futures = ndb.get_multi_async([liked_key(post_id, user.name)
+                                             for post_id in post_ids])
+    counters = counter.get_counters([like_counter(post_id)
+                                     for post_id in post_ids])
+
+    def apply(posts):
+        """Set like_cnt, likes_modified and liked on each post"""
+        likes = [future.get_result() for future in liked_futures]
+        liked = set(like.post_id for like in likes if like)
+        for post_id, post in zip(post_ids, posts):
+            post.like_cnt, post.likes_modified = counters[
+                like_counter(post_id)]
+            post.liked = post_id in liked
+
+    return apply
+
+def load_likes(posts, user):
+    """Set like_cnt, likes_modified, and liked for the logged in user, on
+    each post
+    """
+    load_likes_async([post.key.id() for post in posts], user)(posts)
+
+def like_post(post_id, author):
+    """Like a post and bump its like counter in one transaction
+
+    Returns False if the post doesn't exist, belongs to author, or is
+    already liked by author.
+    """
+    post = post_key(post_id).get()
+    if not post or post.author == author:
+        return False
+    like_key = liked_key(post_id, author)
+
+    def txn():
+        if like_key.get():
+            return False
+        Liked(key=like_key, post_id=str(post_id), author=author).put()
+        counter.add(like_counter(post_id), 1)
+        return True
+
+    if ndb.transaction(txn, xg=True):
+        counter.update_cache(like_counter(post_id), 1)
+        return True
+    return False
+
+def unlike_post(post_id, author):
+    """Remove author's like of a post and drop its like counter in one
+    transaction
+
+    Returns False if author hadn't liked the post.
+    """
+    like_key = liked_key(post_id, author)
+
+    def txn():
+        if not like_key.get():
+            return False
+        like_key.delete()
+        counter.add(like_counter(post_id), -1)
+        return True
+
+    if ndb.transaction(txn, xg=True):
+        counter.update_cache(like_counter(post_id), -1)
+        return True
+    return False
+
+# entity groups per transaction applying likes: every like is its own
+# group in the 'post' layout, plus one counter shard, and a cross-group
+# transaction may span 25
+LIKES_PER_TXN = 24
+
+def apply_likes(post, likes):
+    """Make each author in likes like (True) or not like (False) a post,
+    in batched cross-group transactions, updating its like counter
+
+    Likes by the post's author are ignored. Applying the same likes again
+    changes nothing. Returns the change in the post's like count.
+    """
+    post_id = str(post.key.id())
+    authors = [author for author in likes if author != post.author]
+    total = 0
+    for i in xrange(0, len(authors), LIKES_PER_TXN):
+        batch = authors[i:i + LIKES_PER_TXN]
+        keys = [liked_key(post_id, author) for author in batch]
+
+        def txn():
+            existing = ndb.get_multi(keys)
+            puts = [Liked(key=key, post_id=post_id, author=author)
+                    for key, author, like in zip(keys, batch, existing)
+                    if likes[author] and not like]
+            deletes = [key for key, author, like
+                       in zip(keys, batch, existing)
+                       if like and not likes[author]]
+            ndb.put_multi(puts)
+            ndb.delete_multi(deletes)
+            delta = len(puts) - len(deletes)
+            if delta:
+                counter.add(like_counter(post_id), delta)
+            return delta
+
+        delta = ndb.transaction(txn, xg=True)
+        if delta:
+            counter.update_cache(like_counter(post_id), delta)
+        total += delta
+    return total
+
+# most comment authors counted in one transaction, each touching a
+# counter shard's entity group (a transaction may touch 25)
+AUTHORS_PER_TXN = 20
+# most comments written in one transaction (which may write 500
+# entities), leaving room for the post and the authors' counter shards
+COMMENTS_PER_TXN = 500 - 1 - AUTHORS_PER_TXN
+
+def add_comments(post_id, comments):
+    """Store new comments on a post, with ids already allocated, in as
+    few transactions as possible on the post's entity group, counting
+    them on the post and for their authors
+
+    Comments that were already stored are skipped, so adding the same
+    comments again changes nothing. Returns the comments that were new.
+    """
+    if not comments:
+        return []
+    batches = [[]]
+    authors = set()
+    for comment in comments:
+        if len(batches[-1]) == COMMENTS_PER_TXN or (
+                comment.author not in authors and
+                len(authors) == AUTHORS_PER_TXN):
+            batches.append([])
+            authors = set()
+        batches[-1].append(comment)
+        authors.add(comment.author)
+
+    added = []
+    for batch in batches:
+        def txn():
+            existing = ndb.get_multi([comment.key for comment in batch])
+            new = [comment for comment, stored in zip(batch, existing)
+                   if not stored]
+            ndb.put_multi(new)
+            if new:
+                count_comments(post_id, len(new))
+            for author, count in collections.Counter(
+                    comment.author for comment in new).items():
+                counter.add(author_comment_counter(author), count)
+            return new
+
+        new = ndb.transaction(txn, xg=True)
+        for author, count in collections.Counter(
+                comment.author for comment in new).items():
+            counter.update_cache(author_comment_counter(author), count)
+        added.extend(new)
+    return added
+
+def delete_thread_batch(post_id, batch_size):
+    """Delete a batch of a deleted post's comments and likes, using one
+    batch delete, and drop the comments from the search index
+
+    Deletes the post's like counter once nothing is left. Returns
+    (more, authors): whether there may be more to delete, and the author
+    of each deleted comment.
+    """
+    comments = comment_query(post_id).fetch_async(batch_size)
+    likes = Liked.query(Liked.post_id == str(post_id)).fetch_async(
+        batch_size, keys_only=True)
+    comments = comments.get_result()
+    comment_keys = [comment.key for comment in comments]
+    like_keys = likes.get_result()
+    ndb.delete_multi(comment_keys + like_keys)
+    unindex(comment_doc_id(post_id, key.id()) for key in comment_keys)
+
+    more = len(comment_keys) == batch_size or len(like_keys) == batch_size
+    if not more:
+        counter.delete(like_counter(post_id))
+    return more, [comment.author for comment in comments]
+
+def migrate_post_likes(post_key):
+    """Re-key a post's legacy (auto id) likes and rebuild its like counter
+
+    Meant for a one-off backfill: likes made on the post while it runs
+    may be missed by the count.
+    """
+    post_id = str(post_key.id())
+    likes = Liked.query(Liked.post_id == post_id).fetch()
+    legacy = [like for like in likes if not like.key.string_id()]
+    keyed = [Liked(key=liked_key(post_id, like.author), post_id=post_id,
+                   author=like.author) for like in legacy]
+    ndb.put_multi(keyed)
+    ndb.delete_multi([like.key for like in legacy])
+    counter.reset(like_counter(post_id),
+                  len(set(like.author for like in likes)))
+
+def _move_entity(entity, parent):
+    """Copy a low-level datastore entity under a new parent, keeping its
+    kind, id or name and every property as stored (including auto_now
+    dates)
+    """
+    key = entity.key()
+    if key.name():
+        copy = datastore.Entity(key.kind(), parent=parent, name=key.name(),
+                                unindexed_properties=entity.unindexed_properties())
+    else:
+        copy = datastore.Entity(key.kind(), parent=parent, id=key.id(),
+                                unindexed_properties=entity.unindexed_properties())
+    copy.update(entity)
+    return copy
+
+# most entities put or deleted in one datastore call
+MOVES_PER_CALL = 500
+
+def _put_batches(entities):
+    """Put raw entities, MOVES_PER_CALL at a time"""
+    for i in xrange(0, len(entities), MOVES_PER_CALL):
+        datastore.Put(entities[i:i + MOVES_PER_CALL])
+
+def _delete_batches(keys):
+    """Delete raw entities by key, MOVES_PER_CALL at a time"""
+    for i in xrange(0, len(keys), MOVES_PER_CALL):
+        datastore.Delete(keys[i:i + MOVES_PER_CALL])
+
+def _legacy_thread(kind, post_id):
+    """A post's raw comments or likes (by kind) still in blog_key()'s
+    entity group, by id or name
+    """
+    query = datastore.Query(kind, {'post_id =': str(post_id)})
+    query.Ancestor(blog_key().to_old_key())
+    return dict((entity.key().id_or_name(), entity)
+                for entity in query.Run())
+
+def migrate_post_layout(post_id):
+    """Move a post and its comments out of blog_key()'s entity group into
+    the post's own entity group, and its likes to the root, keeping every
+    id so URLs still work
+
+    Only the post itself moves in a transaction. Its comments and likes
+    are copied in batches before it moves; afterwards whatever changed
+    in the legacy thread meanwhile is copied again (or deleted), and the
+    originals are deleted. Running it again after a failure finishes the
+    move.
+
+    Works on the raw entities through the low-level datastore API (ndb
+    has no way to copy an entity without applying auto_now).
+    """
+    old_key = db.Key.from_path('Post', int(post_id),
+                               parent=blog_key().to_old_key())
+    new_key = db.Key.from_path('Post', int(post_id))
+    # likes become root entities (see liked_key), each its own entity group
+    parents = (('Comment', new_key), ('Liked', None))
+
+    try:
+        datastore.Get(old_key)
+    except datastore_errors.EntityNotFoundError:
+        # already moved: the copies are current, only add what they lack
+        for kind, parent in parents:
+            legacy = _legacy_thread(kind, post_id)
+            if not legacy:
+                continue
+            copies = datastore.Get([db.Key.from_path(kind, name, parent=parent)
+                                    for name in legacy])
+            _put_batches([_move_entity(entity, parent) for entity, copy
+                          in zip(legacy.values(), copies) if not copy])
+            _delete_batches([entity.key() for entity in legacy.values()])
+        return
+
+    copied = {}
+    for kind, parent in parents:
+        copied[kind] = _legacy_thread(kind, post_id)
+        _put_batches([_move_entity(entity, parent)
+                      for entity in copied[kind].values()])
+
+    def txn():
+        post = datastore.Get(old_key)
+        datastore.Put(_move_entity(post, None))
+        datastore.Delete(old_key)
+
+    # keep the datastore from handing out the moved post's id again
+    db.allocate_id_range(new_key, old_key.id(), old_key.id())
+    xg = db.create_transaction_options(xg=True)
+    db.run_in_transaction_options(xg, txn)
+
+    # catch up with writes to the legacy thread while it was copied
+    for kind, parent in parents:
+        legacy = _legacy_thread(kind, post_id)
+        _put_batches([_move_entity(entity, parent)
+                      for name, entity in legacy.items()
+                      if name not in copied[kind] or entity.get(
+                          'last_modified') != copied[kind][name].get(
+                              'last_modified')])
+        _delete_batches([db.Key.from_path(kind, name, parent=parent)
+                         for name in copied[kind] if name not in legacy])
+        _delete_batches([entity.key() for entity in legacy.values()])
@@ -0,0 +1,113 @@
+"""Blog write-behind queue
+
+With settings.WRITE_BEHIND on, likes, unlikes and new comments aren't
+written during the user's request. Instead the handler adds them to the
+'writes' pull queue (see queue.yaml), tagged with the post's id, and
+returns. Shortly after, a task leases everything queued for the post and
+applies it at once: likes coalesced per author, comments in a single
+transaction. Applying a write twice changes nothing, so a batch may
+safely be retried: writes leave the queue only once applied, and a
+failed batch gives up its lease for the retry.
+
+"""
+
+import datetime
+import json
+import time
+
+from google.appengine.api import taskqueue
+
+import settings as s
+from cache import flush_pages
+from blog_model import *
+from blog_search import index_comment
+
+QUEUE = 'writes'
+LEASE_SECONDS = 60
+# most writes applied per task, the most a lease may return
+MAX_WRITES = 1000
+
+def enqueue_write(post_id, write):
+    """Queue a write (a dict, see apply_writes) to a post's thread, and
+    make sure a task will apply it within WRITE_BEHIND_DELAY seconds
+    """
+    taskqueue.Queue(QUEUE).add(taskqueue.Task(
+        payload=json.dumps(write), method='PULL', tag=str(post_id)))
+
+    # one task per post for every WRITE_BEHIND_DELAY seconds, applying
+    # all the writes queued in that time
+    batch = int(time.time() / s.WRITE_BEHIND_DELAY)
+    try:
+        taskqueue.add(url='/admin/apply-writes', params={'post_id': post_id},
+                      name='apply-writes-%s-%d' % (post_id, batch),
+                      countdown=s.WRITE_BEHIND_DELAY)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+def enqueue_like(post_id, author, like=True):
+    """Queue author liking (or with like False, unliking) a post"""
+    enqueue_write(post_id, {'kind': 'like', 'author': author,
+                            'like': like})
+
+def enqueue_comment(post_id, author, content):
+    """Queue a new comment on a post
+
+    Its id is allocated now, so that applying it twice stores it once.
+    """
+    comment_id = Comment.allocate_ids(1, parent=thread_key(post_id))[0]
+    enqueue_write(post_id, {'kind': 'comment', 'author': author,
+                            'content': content, 'id': comment_id,
+                            'created': time.time()})
+
+def apply_writes(post_id):
+    """Apply a batch of a post's queued writes, indexing the comments
+
+    Writes to a post that no longer exists are dropped. The batch is
+    removed from the queue once applied; if applying it fails, its lease
+    is given up so that a retry can lease it again. Returns (leased,
+    more): how many writes were leased, and whether there may be more
+    queued.
+    """
+    queue = taskqueue.Queue(QUEUE)
+    tasks = queue.lease_tasks_by_tag(LEASE_SECONDS, MAX_WRITES,
+                                     tag=str(post_id))
+    if not tasks:
+        return 0, False
+
+    try:
+        _apply_tasks(post_id, tasks)
+    except:
+        for task in tasks:
+            queue.modify_task_lease(task, 0)
+        raise
+    queue.delete_tasks(tasks)
+    return len(tasks), len(tasks) == MAX_WRITES
+
+def _apply_tasks(post_id, tasks):
+    """Apply leased writes to a post, see apply_writes"""
+    post = post_key(post_id).get()
+    if post:
+        # tasks are leased oldest first, so the last write by each
+        # author decides whether they like the post
+        likes = {}
+        comments = []
+        for task in tasks:
+            write = json.loads(task.payload)
+            if write['kind'] == 'like':
+                likes[write['author']] = write['like']
+            elif write['kind'] == 'comment':
+                created = datetime.datetime.utcfromtimestamp(
+                    write['created'])
+                comments.append(Comment(
+                    key=comment_key(post_id, write['id']),
+                    post_id=str(post_id), author=write['author'],
+                    content=write['content'], created=created,
+                    last_modified=created))
+        apply_likes(post, likes)
+        add_comments(post_id, comments)
+        # every comment, not only the new ones, in case an earlier try
+        # stored some but failed before indexing them
+        for comment in comments:
+            index_comment(comment)
+        flush_pages()
@@ -0,0 +1,28 @@
+"""Blog render
+
+Turns the plain text users write for posts and comments into HTML. It
+runs once, when an entity is saved (see Post and Comment in blog_model),
+so pages only ever show the stored HTML.
+
+"""
+
+import re
+
+from jinja2 import escape
+
+_paragraph_break = re.compile(r'\n[ \t]*\n+')
+
+def paragraphs(text):
+    """Split text into paragraphs at blank lines, dropping empty ones"""
+    text = text.replace('\r\n', '\n').replace('\r', '\n')
+    return [p.strip() for p in _paragraph_break.split(text) if p.strip()]
+
+def render_text(text):
+    """Render plain text as HTML: escaped, with a <p> per paragraph and a
+    <br> for each remaining line break
+
+    Everything the user wrote is escaped first, so the only markup in the
+    result is the <p> and <br> tags added here.
+    """
+    return u'\n'.join(u'<p>%s</p>' % unicode(escape(p)).replace(
+        u'\n', u'<br>\n') for p in paragraphs(text))
@@ -0,0 +1,98 @@
+"""Blog search
+
+Full-text search over posts and comments using the App Engine Search
+API. Every post and every comment is a document in one index, kept up to
+date by the handlers that change them. Queries run against the index's
+inverted index, so their cost doesn't grow with the number of posts.
+
+"""
+
+from google.appengine.api import search
+from jinja2 import Markup
+
+import settings as s
+
+index = search.Index(name='blog')
+
+# most documents scored per query, see search.MatchScorer
+SCORED_LIMIT = 1000
+
+def post_doc_id(post_id):
+    """Search document id for a post"""
+    return 'post-%s' % post_id
+
+def comment_doc_id(post_id, comment_id):
+    """Search document id for a comment"""
+    return 'comment-%s-%s' % (post_id, comment_id)
+
+def index_post(post):
+    """Add a post to the search index, or update it there"""
+    index.put(search.Document(
+        doc_id=post_doc_id(post.key.id()),
+        fields=[search.AtomField(name='kind', value='post'),
+                search.AtomField(name='post_id', value=str(post.key.id())),
+                search.AtomField(name='author', value=post.author),
+                search.TextField(name='subject', value=post.subject),
+                search.TextField(name='content', value=post.content),
+                search.DateField(name='created', value=post.created)]))
+
+def index_comment(comment):
+    """Add a comment to the search index, or update it there"""
+    index.put(search.Document(
+        doc_id=comment_doc_id(comment.post_id, comment.key.id()),
+        fields=[search.AtomField(name='kind', value='comment'),
+                search.AtomField(name='post_id', value=comment.post_id),
+                search.AtomField(name='author', value=comment.author),
+                search.TextField(name='content', value=comment.content),
+                search.DateField(name='created', value=comment.created)]))
+
+def unindex(doc_ids):
+    """Remove documents from the search index"""
+    doc_ids = list(doc_ids)
+    # the Search API takes a limited number of documents per call
+    step = search.MAXIMUM_DOCUMENTS_PER_PUT_REQUEST
+    for i in xrange(0, len(doc_ids), step):
+        index.delete(doc_ids[i:i + step])
+
+class SearchResult(object):
+    """A post or comment matching a search, as shown on the results page"""
+    def __init__(self, document):
+        fields = dict((field.name, field.value) for field in document.fields)
+        self.kind = fields['kind']
+        self.post_id = fields['post_id']
+        self.author = fields['author']
+        self.subject = fields.get('subject')
+        self.created = fields['created']
+        snippet = dict((expr.name, expr.value)
+                       for expr in document.expressions).get('snippet', '')
+        # the snippet marks matched words with <b>, keep only those tags
+        # (on the plain text, as Markup.replace would escape the tags)
+        self.snippet = Markup(unicode(Markup.escape(snippet)).replace(
+            u'&lt;b&gt;', u'<b>').replace(u'&lt;/b&gt;', u'</b>'))
+
+def search_page(query_string, cursor=None):
+    """Search posts and comments, best matches first
+
+    Returns (results, next_cursor), where results are SearchResults and
+    next_cursor is a web safe cursor for the next page, or None if there
+    is no next page. Raises search.Error for a malformed query string or
+    cursor.
+    """
+    snippet = 'snippet("%s", content)' % query_string.replace('"', '\\"')
+    options = search.QueryOptions(
+        limit=s.SEARCH_RESULTS_PER_PAGE,
+        cursor=search.Cursor(web_safe_string=cursor or None),
+        sort_options=search.SortOptions(
+            match_scorer=search.MatchScorer(),
+            expressions=[search.SortExpression(
+                expression='_score',
+                direction=search.SortExpression.DESCENDING,
+                default_value=0.0)],
+            limit=SCORED_LIMIT),
+        returned_fields=['kind', 'post_id', 'author', 'subject', 'created'],
+        returned_expressions=[search.FieldExpression(name='snippet',
+                                                     expression=snippet)])
+    results = index.search(search.Query(query_string=query_string,
+                                        options=options))
+    next_cursor = results.cursor and results.cursor.web_safe_string
+    return [SearchResult(doc) for doc in results.results], next_cursor
@@ -0,0 +1,133 @@
+"""Cache
+
+Two-level cache for values that are expensive to rebuild, such as
+rendered HTML fragments: a small in-process LRU in front of memcache.
+
+Also provides WSGI middleware caching whole pages for logged out
+visitors in the same way.
+"""
+
+import collections
+import threading
+import time
+
+import webob
+from google.appengine.api import memcache
+
+class LRUCache(object):
+    """Thread-safe in-process cache holding the most recently used values"""
+    def __init__(self, size):
+        self.size = size
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Get a value, or None if it isn't cached or has expired"""
+        with self._lock:
+            item = self._items.pop(key, None)
+            if item is None:
+                return None
+            expires, value = item
+            if expires and expires < time.time():
+                return None
+            self._items[key] = item
+            return value
+
+    def set(self, key, value, seconds=0):
+        """Cache a value, for at most seconds if given, evicting the least
+        recently used if full
+        """
+        expires = seconds and time.time() + seconds
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (expires, value)
+            while len(self._items) > self.size:
+                self._items.popitem(last=False)
+
+    def delete(self, key):
+        """Drop a value from the cache"""
+        with self._lock:
+            self._items.pop(key, None)
+
+class FragmentCache(object):
+    """In-process LRU backed by memcache
+
+    Keys should change whenever the cached value would, e.g. by including
+    the entity's last_modified, so stale local copies on other instances
+    are simply never asked for again.
+    """
+    def __init__(self, namespace, size=1000):
+        self.namespace = namespace
+        self.local = LRUCache(size)
+
+    def get(self, key):
+        """Get a value from the local cache, falling back to memcache"""
+        value = self.local.get(key)
+        if value is None:
+            value = memcache.get(key, namespace=self.namespace)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value, seconds=0):
+        """Store a value in both cache levels, for at most seconds if
+        given
+        """
+        self.local.set(key, value, seconds)
+        memcache.set(key, value, time=seconds, namespace=self.namespace)
+
+    def delete(self, *keys):
+        """Drop values from both cache levels"""
+        for key in keys:
+            self.local.delete(key)
+        memcache.delete_multi(list(keys), namespace=self.namespace)
+
+PAGE_NAMESPACE = 'pages'
+
+def page_generation():
+    """Current generation of the page cache, part of every page's key"""
+    generation = memcache.get('generation', namespace=PAGE_NAMESPACE)
+    if generation is None:
+        generation = int(time.time())
+        memcache.add('generation', generation, namespace=PAGE_NAMESPACE)
+    return generation
+
+def flush_pages():
+    """Invalidate every cached page, on every instance"""
+    memcache.incr('generation', namespace=PAGE_NAMESPACE,
+                  initial_value=int(time.time()))
+
+class PageCacheMiddleware(object):
+    """WSGI middleware caching whole responses for logged out visitors
+
+    Only GET responses the app marks as shareable (Cache-Control: public)
+    are cached, for their max-age. Requests carrying a session cookie
+    always go to the app. Cached pages still answer conditional GETs.
+    """
+    def __init__(self, app, session_cookie, size=200):
+        self.app = app
+        self.session_cookie = session_cookie
+        self.cache = FragmentCache(PAGE_NAMESPACE, size)
+
+    def __call__(self, environ, start_response):
+        request = webob.Request(environ)
+        if (request.method != 'GET' or
+                request.cookies.get(self.session_cookie)):
+            return self.app(environ, start_response)
+
+        key = '%s:%s' % (page_generation(), request.url)
+        cached = self.cache.get(key)
+        if cached is not None:
+            status, headerlist, body = cached
+            response = webob.Response(body=body, status=status,
+                                      headerlist=list(headerlist))
+            response.conditional_response = True
+            return response(environ, start_response)
+
+        response = request.get_response(self.app)
+        max_age = response.cache_control.max_age
+        if (response.status_int == 200 and response.cache_control.public and
+                max_age and 'Set-Cookie' not in response.headers):
+            self.cache.set(key, (response.status, response.headerlist,
+                                 response.body), max_age)
+        return response(environ, start_response)
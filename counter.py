@@ -0,0 +1,106 @@
+"""Sharded counter
+
+Counts spread over several shard entities so that one hot counter can
+take many more writes per second than a single entity allows. Reads sum
+the shards and are cached in memcache.
+
+The number of shards (settings.COUNTER_SHARDS) may be raised, but never
+lowered, as shards past the new number would no longer be read.
+"""
+
+import datetime
+import random
+
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+import settings as s
+
+NAMESPACE = 'counter'
+# cached last changed time of a counter that was never changed
+NEVER = datetime.datetime.min
+# seconds a counter read from the shards stays cached, bounding how long
+# an increment racing the read can leave the cached value off by it
+CACHE_SECONDS = 60
+
+class CounterShard(ndb.Model):
+    """One shard of a named counter"""
+    count = ndb.IntegerProperty(default=0)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+def _shard_keys(name):
+    """Get Google Datastore keys for every shard of a counter"""
+    return [ndb.Key('CounterShard', '%s-%d' % (name, index))
+            for index in xrange(s.COUNTER_SHARDS)]
+
+def _updated_key(name):
+    """Memcache key for the time a counter last changed"""
+    return 'updated-%s' % name
+
+def get_counters(names):
+    """Get several counters' values and the time each last changed, in
+    one memcache and at most one datastore round trip
+
+    Returns a dict of name to (value, last changed). Last changed is None
+    for a counter that was never changed.
+    """
+    cache_keys = list(names) + [_updated_key(name) for name in names]
+    cached = memcache.get_multi(cache_keys, namespace=NAMESPACE)
+    counters = {}
+    missing = []
+    for name in names:
+        if name in cached and _updated_key(name) in cached:
+            updated = cached[_updated_key(name)]
+            if updated == NEVER:
+                updated = None
+            counters[name] = (cached[name], updated)
+        else:
+            missing.append(name)
+
+    if missing:
+        keys = []
+        for name in missing:
+            keys.extend(_shard_keys(name))
+        shards = ndb.get_multi(keys)
+        to_cache = {}
+        for i, name in enumerate(missing):
+            batch = shards[i * s.COUNTER_SHARDS:(i + 1) * s.COUNTER_SHARDS]
+            batch = [shard for shard in batch if shard]
+            count = sum(shard.count for shard in batch)
+            updated = max([shard.updated for shard in batch] or [None])
+            counters[name] = (count, updated)
+            to_cache[name] = count
+            to_cache[_updated_key(name)] = updated or NEVER
+        memcache.add_multi(to_cache, time=CACHE_SECONDS,
+                           namespace=NAMESPACE)
+    return counters
+
+def add(name, delta):
+    """Add delta to a random shard of a counter
+
+    May be called inside a (cross-group) transaction. Call update_cache
+    once the change has been committed.
+    """
+    key = random.choice(_shard_keys(name))
+    shard = key.get() or CounterShard(key=key)
+    shard.count += delta
+    shard.put()
+
+def update_cache(name, delta):
+    """Apply a committed change to the cached value, if there is one"""
+    if delta >= 0:
+        memcache.incr(name, delta, namespace=NAMESPACE)
+    else:
+        memcache.decr(name, -delta, namespace=NAMESPACE)
+    memcache.set(_updated_key(name), datetime.datetime.utcnow(),
+                 namespace=NAMESPACE)
+
+def reset(name, value):
+    """Set a counter to value, e.g. when backfilling it"""
+    delete(name)
+    CounterShard(key=_shard_keys(name)[0], count=value).put()
+
+def delete(name):
+    """Delete a counter's shards"""
+    ndb.delete_multi(_shard_keys(name))
+    memcache.delete_multi([name, _updated_key(name)], namespace=NAMESPACE)
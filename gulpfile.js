@@ -1,12 +1,70 @@
-var gulp = require('gulp'),
-    prettify = require('gulp-html-prettify');
-
-gulp.task('templates', function() {
-  gulp.src('./templates/*.html')
-    .pipe(prettify({indent_char: ' ', indent_size: 4}))
-    .pipe(gulp.dest('./templates/'))
-});
-
-gulp.task('default', function() {
-  // place code for your default task here
-});
\ No newline at end of file
+var gulp = require('gulp'),
+    concat = require('gulp-concat'),
+    cleanCSS = require('gulp-clean-css'),
+    gulpif = require('gulp-if'),
+    imagemin = require('gulp-imagemin'),
+    prettify = require('gulp-html-prettify'),
+    rev = require('gulp-rev'),
+    uglify = require('gulp-uglify'),
+    del = require('del'),
+    merge = require('merge-stream');
+
+// bundle name -> source files, relative to static/; shared with assets.py
+var bundles = require('./assets.json');
+
+var tmp = './.build/',
+    dist = './static/dist/';
+
+gulp.task('templates', function() {
+  gulp.src('./templates/*.html')
+    .pipe(prettify({indent_char: ' ', indent_size: 4}))
+    .pipe(gulp.dest('./templates/'))
+});
+
+gulp.task('clean', function() {
+  return del([tmp, dist]);
+});
+
+// concatenate and minify each bundle
+gulp.task('bundles', ['clean'], function() {
+  return merge(Object.keys(bundles).map(function(name) {
+    return gulp.src(bundles[name].map(function(src) {
+        return './static/' + src;
+      }))
+      .pipe(concat(name))
+      // keep url()s as written, they are already relative to css/
+      .pipe(gulpif('*.css', cleanCSS({rebase: false})))
+      .pipe(gulpif('*.js', uglify()))
+      .pipe(gulp.dest(tmp));
+  }));
+});
+
+gulp.task('images', ['clean'], function() {
+  return gulp.src('./static/img/**/*', {base: './static/'})
+    .pipe(imagemin())
+    .pipe(gulp.dest(tmp));
+});
+
+gulp.task('vendor', ['clean'], function() {
+  return gulp.src('./static/js/vendor/**/*', {base: './static/'})
+    .pipe(gulp.dest(tmp));
+});
+
+// font-awesome's css refers to its fonts by name, so they aren't renamed
+// (and app.yaml serves them with a short expiration instead)
+gulp.task('fonts', ['clean'], function() {
+  return gulp.src('./static/fonts/**/*', {base: './static/'})
+    .pipe(gulp.dest(dist));
+});
+
+// fingerprint every built file with its content hash, and write the
+// manifest assets.py reads (outside static/, which app code can't read)
+gulp.task('build', ['bundles', 'images', 'vendor', 'fonts'], function() {
+  return gulp.src(tmp + '**/*', {base: tmp})
+    .pipe(rev())
+    .pipe(gulp.dest(dist))
+    .pipe(rev.manifest())
+    .pipe(gulp.dest('./'));
+});
+
+gulp.task('default', ['build']);
@@ -5,29 +5,68 @@ Framework includes the ability to register, login, and logout users.
 
 """
 
+import binascii
 import hashlib
 import hmac
-import random
+import logging
+import os
 import re
-from string import letters
+import time
 
 import webapp2
-from google.appengine.ext import db
+from google.appengine.ext import ndb
 
 import settings as s
+import stats
 
-def make_secure_val(val):
-    """Creates a secure value for storing in a cookie."""
-    return '%s|%s' % (val, hmac.new(s.SECRET, val).hexdigest())
+# one keyed SHA-256 hasher per secret, copied for each signature rather
+# than rekeyed
+_signers = [hmac.new(secret, digestmod=hashlib.sha256)
+            for secret in s.SECRETS]
+
+def _sign(signer, msg):
+    """HMAC-SHA256 of msg, as hex, using a precomputed keyed hasher"""
+    signer = signer.copy()
+    signer.update(msg)
+    return signer.hexdigest()
+
+def make_secure_val(val, max_age=None):
+    """Creates a secure value for storing in a cookie.
+
+    The value is signed with the first of settings.SECRETS, along with
+    when it expires (max_age seconds from now, SESSION_MAX_AGE by default).
+    """
+    expires = int(time.time()) + (max_age or s.SESSION_MAX_AGE)
+    msg = '%s|%d' % (val, expires)
+    return '%s|%s' % (msg, _sign(_signers[0], msg))
 
 def check_secure_val(secure_val):
-    """Reads a secure cookie to make sure the hashed value is equal
-    to the input password.
+    """Reads a secure cookie value, returning the value if it was signed
+    with any of settings.SECRETS and hasn't expired, else None
     """
-    val = secure_val.split('|')[0]
-    if secure_val == make_secure_val(val):
+    if isinstance(secure_val, unicode):
+        secure_val = secure_val.encode('utf-8')
+    msg, _, sig = secure_val.rpartition('|')
+    val, _, expires = msg.rpartition('|')
+    if not expires.isdigit():
+        return None
+    # check every key, so timing doesn't tell which one matched
+    valid = False
+    for signer in _signers:
+        valid |= hmac.compare_digest(sig, _sign(signer, msg))
+    if valid and int(expires) > time.time():
         return val
 
+class SessionUser(object):
+    """Logged in user, as read from the session cookie
+
+    Carries only what pages need (id and name) so that no datastore
+    get is needed to show them.
+    """
+    def __init__(self, uid, name):
+        self.id = uid
+        self.name = name
+
 class Handler(webapp2.RequestHandler):
     """Generic web handler"""
     def write(self, *a, **kw):
@@ -43,12 +82,48 @@ class Handler(webapp2.RequestHandler):
         """Render Jinja2 template"""
         self.write(self.render_str(template, **kw))
 
+    def not_modified(self, last_modified=None, *parts):
+        """Set cache validators for the page about to be rendered, and
+        answer a conditional GET
+
+        The ETag covers parts (whatever the page shows that can change),
+        the viewer and the app version. last_modified is the newest change
+        to anything the page shows. Returns True, having set a 304
+        response, if the client's copy is still current; the handler
+        should then return without rendering.
+        """
+        viewer = self.user and (self.user.id, self.user.name)
+        version = os.environ.get('CURRENT_VERSION_ID')
+        etag = hashlib.sha1(repr((version, viewer) + parts)).hexdigest()
+        self.response.etag = etag
+        if last_modified:
+            self.response.last_modified = last_modified
+
+        self.response.headers['Vary'] = 'Cookie'
+        if self.user:
+            self.response.cache_control = 'private, no-cache'
+        else:
+            self.response.cache_control = 'public, max-age=%d' % (
+                s.PAGE_MAX_AGE)
+
+        if self.request.if_none_match:
+            current = etag in self.request.if_none_match
+        else:
+            since = self.request.if_modified_since
+            current = bool(last_modified and since and
+                           last_modified.replace(microsecond=0) <=
+                           since.replace(tzinfo=None))
+        if current:
+            self.response.status = 304
+        return current
+
     def set_secure_cookie(self, name, val):
         """Create/write cookie"""
         cookie_val = make_secure_val(val)
         self.response.headers.add_header(
             'Set-Cookie',
-            '%s=%s; Path=/' % (name, cookie_val))
+            '%s=%s; Path=/; Max-Age=%d' % (name, cookie_val,
+                                           s.SESSION_MAX_AGE))
 
     def read_secure_cookie(self, name):
         """Read secure cookie by unhashing it"""
@@ -59,12 +134,66 @@ class Handler(webapp2.RequestHandler):
 
     def initialize(self, *a, **kw):
         """If logged in via cookie, initialize page with user"""
+        stats.start()
         webapp2.RequestHandler.initialize(self, *a, **kw)
-        uid = self.read_secure_cookie('user_id')
-        if uid:
-            self.user = user_by_id(int(uid))
-        else:
-            self.user = None
+        self.user = None
+        with stats.timer('session'):
+            session = self.read_secure_cookie('user_id')
+        if session:
+            uid, _, name = session.partition(':')
+            if name:
+                self.user = SessionUser(int(uid), name)
+
+    def dispatch(self):
+        """Dispatch the request, then log and aggregate its stats
+
+        In development the stats are also sent in a Server-Timing header.
+        """
+        try:
+            webapp2.RequestHandler.dispatch(self)
+        finally:
+            route = self.request.route
+            summary = stats.finish(route and route.template,
+                                   self.response.status_int)
+            if summary and s.DEBUG:
+                self.response.headers['Server-Timing'] = server_timing(
+                    summary)
+
+def server_timing(summary):
+    """Format a request's stats (see stats.finish) as a Server-Timing
+    header
+    """
+    metrics = ['handler;dur=%.1f' % summary['handler_ms'],
+               'render;dur=%.1f' % summary['render_ms']]
+    for service, rpcs in sorted(summary['rpcs'].items()):
+        metrics.append('%s;desc="%d calls";dur=%.1f' % (
+            service, rpcs['count'], rpcs['ms']))
+    for name, ms in sorted(summary['timings'].items()):
+        metrics.append('%s;dur=%.1f' % (name, ms))
+    for name, render in sorted(summary['templates'].items()):
+        metrics.append('template;desc="%s x%d";dur=%.1f' % (
+            name, render['count'], render['ms']))
+    return ', '.join(metrics)
+
+class Warmup(Handler):
+    """Web handler for App Engine warmup requests
+
+    Loads every template, so that new instances don't compile them on
+    their first real requests.
+    """
+    def get(self):
+        """Warmup get"""
+        for template in s.jinja_env.list_templates(extensions=['html']):
+            s.jinja_env.get_template(template)
+
+class Stats(Handler):
+    """Admin page showing per route request stats from every instance"""
+    def get(self):
+        """Stats get"""
+        stats.flush()
+        routes = [route.template for route in self.app.router.match_routes]
+        self.render("stats.html", routes=stats.load(routes),
+                    flush_seconds=stats.FLUSH_SECONDS)
 
 class NotFoundPageHandler(Handler):
     """404 html page"""
@@ -75,45 +204,126 @@ class NotFoundPageHandler(Handler):
 
 def user_key(group='default'):
     """Get Google Datastore key for users"""
-    return db.Key.from_path('users', group)
+    return ndb.Key('users', group)
 
-class User(db.Model):
+class User(ndb.Model):
     """User model for Google Datastore"""
-    name = db.StringProperty(required=True)
-    pw_hash = db.StringProperty(required=True)
-    email = db.StringProperty()
+    name = ndb.StringProperty(required=True)
+    pw_hash = ndb.StringProperty(required=True)
+    email = ndb.StringProperty()
 
 def user_by_id(uid):
     """Get user by user_id"""
     return User.get_by_id(uid, parent=user_key())
 
+class UserName(ndb.Model):
+    """Unique index of user names, keyed by name, for strongly consistent
+    lookups by name
+    """
+    user_id = ndb.IntegerProperty(required=True)
+
+def user_name_key(name):
+    """Get Google Datastore key for a user name's index entry"""
+    return ndb.Key('UserName', name, parent=user_key())
+
+def unindexed_user_by_name(name):
+    """Get a user registered before the name index by name, unless
+    settings.USER_NAMES_INDEXED says there are none left
+    """
+    if not s.USER_NAMES_INDEXED:
+        return User.query(User.name == name, ancestor=user_key()).get()
+
 def user_by_name(name):
     """Get user by name"""
-    u = User.all().filter('name =', name).get()
-    return u
+    index = user_name_key(name).get()
+    if index:
+        return user_by_id(index.user_id)
+    return unindexed_user_by_name(name)
 
 def user_register(name, pw_hash, email=None):
-    """Initialize new user entity for Google Datastore"""
-    return User(parent=user_key(),
-                name=name,
-                pw_hash=pw_hash,
-                email=email)
+    """Create and store a new user, claiming the name in the same
+    transaction
+
+    Returns the new user, or None if the name is already taken.
+    """
+    def txn():
+        if user_name_key(name).get() or unindexed_user_by_name(name):
+            return None
+        user = User(parent=user_key(),
+                    name=name,
+                    pw_hash=pw_hash,
+                    email=email)
+        user.put()
+        UserName(key=user_name_key(name), user_id=user.key.id()).put()
+        return user
+
+    return ndb.transaction(txn)
+
+def index_user_name(user):
+    """Add a user's name to the name index, for users registered
+    before the index existed
 
-def make_salt(length=5):
+    A name already indexed for another user is left to that user, and
+    the conflict logged.
+    """
+    def txn():
+        index = user_name_key(user.name).get()
+        if index:
+            return index.user_id
+        UserName(key=user_name_key(user.name), user_id=user.key.id()).put()
+        return user.key.id()
+
+    owner = ndb.transaction(txn)
+    if owner != user.key.id():
+        logging.warning('user name %s of user %s is already indexed for '
+                        'user %s', user.name, user.key.id(), owner)
+
+def make_salt(length=16):
     """Create new salt"""
-    return ''.join(random.choice(letters) for x in xrange(length))
+    return binascii.hexlify(os.urandom(length))
+
+def pbkdf2_sha256(pw, salt, cost):
+    """PBKDF2-HMAC-SHA256 password hasher, cost is the iteration count"""
+    return binascii.hexlify(hashlib.pbkdf2_hmac('sha256', pw, salt, cost))
 
-def make_pw_hash(name, pw, salt=None):
-    """Hash input password with given or new salt"""
-    if not salt:
-        salt = make_salt()
+# password hashers by name, each taking (utf-8 password, salt, cost)
+PW_HASHERS = {'pbkdf2_sha256': pbkdf2_sha256}
+
+def make_pw_hash(name, pw, salt=None, hasher=None, cost=None):
+    """Hash input password with given or new salt
+
+    Uses settings.PW_HASHER and PW_HASH_COST unless told otherwise, and
+    returns 'hasher$cost$salt$hash' so the hash can be checked after
+    the settings change.
+    """
+    hasher = str(hasher or s.PW_HASHER)
+    cost = cost or s.PW_HASH_COST
+    salt = str(salt or make_salt())
+    h = PW_HASHERS[hasher](pw.encode('utf-8'), salt, cost)
+    return '%s$%d$%s$%s' % (hasher, cost, salt, h)
+
+def make_legacy_pw_hash(name, pw, salt):
+    """Hash input password the way passwords were stored before hashes
+    carried a hasher prefix: 'salt,sha256(name + pw + salt)'
+    """
     h = hashlib.sha256(name + pw + salt).hexdigest()
     return '%s,%s' % (salt, h)
 
 def valid_password(name, password, h):
     """Check if input password matches stored password"""
-    salt = h.split(',')[0]
-    return h == make_pw_hash(name, password, salt)
+    if '$' not in h:
+        salt = h.split(',')[0]
+        return hmac.compare_digest(str(h), str(make_legacy_pw_hash(
+            name, password, salt)))
+    hasher, cost, salt, _ = h.split('$')
+    return hmac.compare_digest(str(h), make_pw_hash(
+        name, password, salt, hasher, int(cost)))
+
+def pw_hash_outdated(h):
+    """Check if a stored password hash uses other than the configured
+    hasher and cost
+    """
+    return not h.startswith('%s$%d$' % (s.PW_HASHER, s.PW_HASH_COST))
 
 def valid_username_re(username):
     """Check if input username meets requirements"""
@@ -134,11 +344,16 @@ def verify_login(name, pw):
     """Check user login matches stored password"""
     user = user_by_name(name)
     if user and valid_password(name, pw, user.pw_hash):
+        if pw_hash_outdated(user.pw_hash):
+            # rehash while we have the password
+            user.pw_hash = make_pw_hash(name, pw)
+            user.put()
         return user
 
 def login(webHandler, user):
-    """Login by setting secure cookie with user_id"""
-    webHandler.set_secure_cookie('user_id', str(user.key().id()))
+    """Login by setting secure cookie with user_id and name"""
+    webHandler.set_secure_cookie('user_id',
+                                 '%s:%s' % (user.key.id(), user.name))
 
 class Signup(Handler):
     """Web handler for registering user"""
@@ -179,16 +394,12 @@ class Signup(Handler):
 
     def done(self, *a, **kw):
         """Signup done registering"""
-        #make sure the user doesn't already exist
-        user = user_by_name(self.username)
-        if user:
+        self.pw_hash = make_pw_hash(self.username, self.password)
+        user = user_register(self.username, self.pw_hash, self.email)
+        if not user:
             msg = "That username already exists."
             self.render('signup-form.html', error_username=msg)
         else:
-            self.pw_hash = make_pw_hash(self.username, self.password)
-            user = user_register(self.username, self.pw_hash, self.email)
-            user.put()
-
             login(self, user)
             self.redirect('/blog')
 
@@ -222,10 +433,14 @@ class MainPage(Handler):
     """Web handler for main page"""
     def get(self):
         """Main get"""
+        if self.not_modified():
+            return
         self.render("front.html")
 
 class About(Handler):
     """Web hanlder for about page"""
     def get(self):
         """About get"""
+        if self.not_modified():
+            return
         self.render("about.html")
@@ -8,24 +8,58 @@ Assigns URLs their Python handlers.
 
 import webapp2
 
-from handler import MainPage, About, Signup, Login, Logout, NotFoundPageHandler
-from blog import blog_controller
+from cache import PageCacheMiddleware
+from ratelimit import RateLimit, RateLimitMiddleware
+from handler import MainPage, About, Signup, Login, Logout, Warmup, Stats, NotFoundPageHandler
+from blog import blog_controller, blog_admin
 
-app = webapp2.WSGIApplication([('/', MainPage),
-                               ('/about', About),
-                               ('/signup', Signup),
-                               ('/login', Login),
-                               ('/logout', Logout),
-                               ('/blog/?', blog_controller.BlogFront),
-                               ('/blog/([0-9]+)', blog_controller.PostPage),
-                               ('/blog/newpost', blog_controller.NewPost),
-                               ('/blog/edit-post/([0-9]+)', blog_controller.EditPost),
-                               ('/blog/delete-post/([0-9]+)', blog_controller.DeletePost),
-                               ('/blog/add-comment/([0-9]+)', blog_controller.NewComment),
-                               ('/blog/edit-comment/([0-9]+)', blog_controller.EditComment),
-                               ('/blog/delete-comment/([0-9]+)', blog_controller.DeleteComment),
-                               ('/blog/like/([0-9]+)', blog_controller.Like),
-                               ('/blog/unlike/([0-9]+)', blog_controller.UnLike),
-                               ('/.*', NotFoundPageHandler)
-                               ],
-                              debug=True)
+application = webapp2.WSGIApplication([('/', MainPage),
+                                       ('/about', About),
+                                       ('/signup', Signup),
+                                       ('/login', Login),
+                                       ('/logout', Logout),
+                                       ('/blog/?', blog_controller.BlogFront),
+                                       ('/blog/([0-9]+)', blog_controller.PostPage),
+                                       ('/blog/author/([a-zA-Z0-9_-]+)', blog_controller.AuthorPage),
+                                       ('/blog/newpost', blog_controller.NewPost),
+                                       ('/blog/search', blog_controller.Search),
+                                       ('/blog/edit-post/([0-9]+)', blog_controller.EditPost),
+                                       ('/blog/delete-post/([0-9]+)', blog_controller.DeletePost),
+                                       ('/blog/add-comment/([0-9]+)', blog_controller.NewComment),
+                                       ('/blog/edit-comment/([0-9]+)/([0-9]+)', blog_controller.EditComment),
+                                       ('/blog/delete-comment/([0-9]+)/([0-9]+)', blog_controller.DeleteComment),
+                                       ('/blog/like/([0-9]+)', blog_controller.Like),
+                                       ('/blog/unlike/([0-9]+)', blog_controller.UnLike),
+                                       ('/admin/migrate-usernames', blog_admin.MigrateUserNames),
+                                       ('/admin/migrate-layout', blog_admin.MigrateLayout),
+                                       ('/admin/migrate-likes', blog_admin.MigrateLikes),
+                                       ('/admin/migrate-comment-counts', blog_admin.MigrateCommentCounts),
+                                       ('/admin/migrate-user-counts', blog_admin.MigrateUserCounts),
+                                       ('/admin/migrate-search', blog_admin.MigrateSearchIndex),
+                                       ('/admin/migrate-content-html', blog_admin.MigrateContentHtml),
+                                       ('/admin/delete-thread', blog_admin.DeleteThread),
+                                       ('/admin/apply-writes', blog_admin.ApplyWrites),
+                                       ('/_ah/warmup', Warmup),
+                                       ('/_stats', Stats),
+                                       ('/.*', NotFoundPageHandler)
+                                       ],
+                                      debug=True)
+
+# token buckets per client IP and per logged in user, by route template:
+# RateLimit(tokens, refilled over seconds, methods)
+rate_limits = {'/login': RateLimit(10, 60),
+               '/signup': RateLimit(5, 3600),
+               '/blog/newpost': RateLimit(10, 3600),
+               '/blog/edit-post/([0-9]+)': RateLimit(30, 3600),
+               '/blog/delete-post/([0-9]+)': RateLimit(30, 3600),
+               '/blog/add-comment/([0-9]+)': RateLimit(10, 60),
+               '/blog/edit-comment/([0-9]+)/([0-9]+)': RateLimit(30, 600),
+               '/blog/delete-comment/([0-9]+)/([0-9]+)': RateLimit(30, 600),
+               '/blog/like/([0-9]+)': RateLimit(30, 60, methods=('GET',)),
+               '/blog/unlike/([0-9]+)': RateLimit(30, 60, methods=('GET',)),
+               '/blog/search': RateLimit(60, 60, methods=('GET',))}
+
+# logged out visitors are served from the page cache where possible, and
+# throttled clients are turned away before reaching either
+app = RateLimitMiddleware(PageCacheMiddleware(application, 'user_id'),
+                          application.router, rate_limits, 'user_id')
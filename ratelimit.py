@@ -0,0 +1,127 @@
+"""Rate limiting
+
+WSGI middleware throttling clients on chosen routes with token buckets,
+one per route for each client IP and each logged in user. Buckets live
+in memcache, so limits hold across instances, with an in-process copy
+used whenever memcache is unavailable. Clients over a limit get a 429
+response with Retry-After, before the app (or the datastore) does any
+work for them.
+
+"""
+
+import logging
+import math
+import threading
+import time
+
+import webapp2
+import webob.exc
+from google.appengine.api import memcache
+
+from cache import LRUCache
+from handler import check_secure_val
+
+NAMESPACE = 'ratelimit'
+# attempts at an atomic memcache update before using the local bucket
+CAS_RETRIES = 3
+
+class RateLimit(object):
+    """A token bucket of tokens requests, refilled over seconds, applied
+    to requests with one of methods
+    """
+    def __init__(self, tokens, seconds, methods=('POST',)):
+        self.tokens = tokens
+        self.seconds = seconds
+        self.methods = methods
+
+    def take(self, tat, now):
+        """Take a token from a bucket, given as its theoretical arrival
+        time (GCRA): when it would be full again, or None if unused
+
+        Returns (new tat, 0) if a token was taken, or (None, seconds until
+        one will be available) if the bucket is empty.
+        """
+        interval = float(self.seconds) / self.tokens
+        tat = max(tat or now, now) + interval
+        wait = tat - self.seconds - now
+        if wait > 0:
+            return None, wait
+        return tat, 0
+
+class RateLimitMiddleware(object):
+    """WSGI middleware applying RateLimits to an app's routes
+
+    limits maps route templates in the app's router to RateLimits.
+    Logged in users are identified by the session cookie, as Handler
+    does.
+    """
+    def __init__(self, app, router, limits, session_cookie, size=10000):
+        templates = set(route.template for route in router.match_routes)
+        unknown = set(limits) - templates
+        if unknown:
+            raise ValueError('no such routes: %s' % ', '.join(unknown))
+        self.app = app
+        self.router = router
+        self.limits = limits
+        self.session_cookie = session_cookie
+        self.local = LRUCache(size)
+        self._local_lock = threading.Lock()
+
+    def __call__(self, environ, start_response):
+        request = webapp2.Request(environ)
+        try:
+            route = self.router.match(request)[0]
+        except webob.exc.HTTPException:
+            return self.app(environ, start_response)
+        limit = self.limits.get(route.template)
+        if not limit or request.method not in limit.methods:
+            return self.app(environ, start_response)
+
+        clients = ['ip:%s' % request.remote_addr]
+        session = request.cookies.get(self.session_cookie)
+        session = session and check_secure_val(session)
+        if session:
+            clients.append('user:%s' % session.partition(':')[0])
+
+        wait = max(self.take(route.template, client, limit)
+                   for client in clients)
+        if wait:
+            logging.info('rate limited %s on %s', ', '.join(clients),
+                         route.template)
+            start_response('429 Too Many Requests', [
+                ('Content-Type', 'text/plain; charset=utf-8'),
+                ('Retry-After', str(int(math.ceil(wait))))])
+            return ['Too many requests, please try again later.\n']
+        return self.app(environ, start_response)
+
+    def take(self, template, client, limit):
+        """Take a token from a client's bucket for a route, returning 0,
+        or the seconds to wait if it is empty
+        """
+        key = '%s|%s' % (template, client)
+        # an idle bucket is full, so it can expire once refilled
+        expires = limit.seconds + 1
+        mc = memcache.Client()
+        for _ in xrange(CAS_RETRIES):
+            now = time.time()
+            tat = mc.gets(key, namespace=NAMESPACE)
+            new_tat, wait = limit.take(tat, now)
+            if wait:
+                return wait
+            if tat is None:
+                stored = mc.add(key, new_tat, time=expires,
+                                namespace=NAMESPACE)
+            else:
+                stored = mc.cas(key, new_tat, time=expires,
+                                namespace=NAMESPACE)
+            if stored:
+                return 0
+
+        # memcache is down or the bucket is too contended, use this
+        # instance's bucket instead
+        with self._local_lock:
+            now = time.time()
+            new_tat, wait = limit.take(self.local.get(key), now)
+            if not wait:
+                self.local.set(key, new_tat, expires)
+            return wait
@@ -5,9 +5,68 @@ Store global settings here for use elsewhere in the project.
 
 import os
 import jinja2
+from google.appengine.api import memcache
+
+import assets
+import stats
+
+# running under dev_appserver.py rather than in production
+DEBUG = os.environ.get('SERVER_SOFTWARE', '').startswith('Development')
 
 template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-jinja_env = jinja2.Environment(loader=jinja2.FileSystemLoader(template_dir),
-                               autoescape=True)
+# Templates are compiled once per app version and shared between
+# instances through memcache. Outside of development they never change,
+# so don't check the template files for changes on every render.
+jinja_env = jinja2.Environment(
+    loader=jinja2.FileSystemLoader(template_dir),
+    autoescape=True,
+    auto_reload=DEBUG,
+    bytecode_cache=jinja2.MemcachedBytecodeCache(
+        memcache,
+        prefix='jinja2/%s/' % os.environ.get('CURRENT_VERSION_ID', '')))
+# time every render for the request stats
+jinja_env.template_class = stats.TimedTemplate
+jinja_env.globals.update(asset_url=assets.asset_url,
+                         asset_urls=assets.asset_urls)
+
+# keys for signing cookies: the first signs, all of them are accepted. To
+# rotate, put a new key first and drop the old one after SESSION_MAX_AGE.
+SECRETS = ['imsosecret']
+
+# seconds a login cookie stays valid
+SESSION_MAX_AGE = 30 * 24 * 60 * 60
+
+POSTS_PER_PAGE = 10
+COMMENTS_PER_PAGE = 20
+SEARCH_RESULTS_PER_PAGE = 10
+
+# whether every user is in the user name index; until /admin/migrate-usernames
+# has run, names missing from the index are also looked up by query
+USER_NAMES_INDEXED = False
+
+# number of rendered posts/comments kept in each instance's memory
+RENDER_CACHE_SIZE = 1000
+
+# 'post': each post is its own entity group, holding its comments and likes
+# 'blog': legacy layout, every post, comment and like in one entity group
+# 'migrating': finds each post in whichever layout it is in, at the cost of
+# a get per post; deploy it before running /admin/migrate-layout, and
+# 'post' once that has finished
+BLOG_LAYOUT = 'blog'
+
+# shards per sharded counter (see counter.py); may be raised, never lowered
+COUNTER_SHARDS = 20
+
+# queue likes and new comments, and write them in batches per post a few
+# seconds later (see blog/blog_queue.py), instead of during the request
+WRITE_BEHIND = False
+WRITE_BEHIND_DELAY = 2
+
+# seconds shared caches may serve a page to logged out visitors
+PAGE_MAX_AGE = 60
 
-SECRET = 'imsosecret'
+# password hasher (see handler.PW_HASHERS) and its cost for new hashes;
+# pick the cost with bench/password_hash.py. Stored hashes using anything
+# else are upgraded on the user's next login.
+PW_HASHER = 'pbkdf2_sha256'
+PW_HASH_COST = 20000
@@ -0,0 +1,219 @@
+"""Request stats
+
+Records what each request spends its time on: API calls (count and time,
+per service), rendering each template, and the handler as a whole (see
+Handler.initialize and Handler.dispatch). Every request is logged as one
+JSON line, and the numbers are aggregated per route into histograms in
+memcache, shared by every instance, for the /_stats admin page.
+
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import jinja2
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+NAMESPACE = 'stats-%s' % os.environ.get('CURRENT_VERSION_ID', '')
+
+# seconds an instance collects stats before adding them to memcache
+FLUSH_SECONDS = 10
+
+# histogram bucket upper bounds
+MS_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+RPC_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+# aggregated per route: name -> buckets
+METRICS = (('handler_ms', MS_BUCKETS),
+           ('render_ms', MS_BUCKETS),
+           ('datastore_ms', MS_BUCKETS),
+           ('datastore_rpcs', RPC_BUCKETS))
+
+_local = threading.local()
+
+class RequestStats(object):
+    """What one request spent its time on, in milliseconds"""
+    def __init__(self):
+        self.start = time.time()
+        # service -> [count, ms]
+        self.rpcs = {}
+        # template name -> [count, ms], including templates rendered inside
+        self.templates = {}
+        # name -> ms, see timer
+        self.timings = {}
+        # time in templates, not counting those rendered inside others
+        self.render_ms = 0.0
+        self.render_depth = 0
+        self.rpc_starts = {}
+
+    def summary(self, route, status):
+        """Everything recorded, as a dict ready for JSON"""
+        rpcs = self.rpcs.get('datastore_v3', (0, 0.0))
+        return {'route': route,
+                'status': status,
+                'handler_ms': (time.time() - self.start) * 1000,
+                'render_ms': self.render_ms,
+                'datastore_rpcs': rpcs[0],
+                'datastore_ms': rpcs[1],
+                'rpcs': dict((service, {'count': count, 'ms': ms})
+                             for service, (count, ms)
+                             in self.rpcs.items()),
+                'templates': dict((name, {'count': count, 'ms': ms})
+                                  for name, (count, ms)
+                                  in self.templates.items()),
+                'timings': self.timings}
+
+def current():
+    """Stats of the request being handled by this thread, if recording"""
+    return getattr(_local, 'stats', None)
+
+def start():
+    """Start recording stats for the request handled by this thread"""
+    _local.stats = RequestStats()
+    return _local.stats
+
+def finish(route, status):
+    """Stop recording, log the request's stats and add them to its
+    route's aggregates, returning the summary (or None if not recording)
+    """
+    stats = current()
+    _local.stats = None
+    if not stats:
+        return None
+    summary = stats.summary(route, status)
+    logging.info('request_stats %s', json.dumps(summary, sort_keys=True))
+    _aggregate(summary)
+    return summary
+
+@contextlib.contextmanager
+def timer(name):
+    """Time a block, adding it to the current request's timings"""
+    stats = current()
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        if stats:
+            stats.timings[name] = stats.timings.get(name, 0.0) + (
+                time.time() - start_time) * 1000
+
+def _pre_call(service, call, request, response, rpc):
+    """API pre-call hook, noting when the call started"""
+    stats = current()
+    if stats:
+        stats.rpc_starts[id(rpc)] = time.time()
+
+def _post_call(service, call, request, response, rpc):
+    """API post-call hook, counting the call and its time
+
+    Async calls are timed from when they are made until their result is
+    used, so overlapping calls each count their full time.
+    """
+    stats = current()
+    if stats:
+        started = stats.rpc_starts.pop(id(rpc), None)
+        entry = stats.rpcs.setdefault(service, [0, 0.0])
+        entry[0] += 1
+        if started:
+            entry[1] += (time.time() - started) * 1000
+
+apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('stats', _pre_call)
+apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('stats', _post_call)
+
+class TimedTemplate(jinja2.Template):
+    """Jinja2 template timing its renders, see settings.jinja_env"""
+    def render(self, *args, **kwargs):
+        """Render the template, adding the time to the current request's
+        stats
+        """
+        stats = current()
+        if not stats:
+            return jinja2.Template.render(self, *args, **kwargs)
+
+        stats.render_depth += 1
+        start_time = time.time()
+        try:
+            return jinja2.Template.render(self, *args, **kwargs)
+        finally:
+            elapsed = (time.time() - start_time) * 1000
+            stats.render_depth -= 1
+            entry = stats.templates.setdefault(self.name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+            if not stats.render_depth:
+                stats.render_ms += elapsed
+
+def _bucket(value, bounds):
+    """Label of the histogram bucket holding value"""
+    for bound in bounds:
+        if value <= bound:
+            return str(bound)
+    return 'inf'
+
+_pending = {}
+_pending_lock = threading.Lock()
+_last_flush = [time.time()]
+
+def _aggregate(summary):
+    """Add a request's summary to this instance's pending aggregates,
+    flushing them to memcache every FLUSH_SECONDS
+    """
+    route = summary['route']
+    with _pending_lock:
+        key = '%s|requests' % route
+        _pending[key] = _pending.get(key, 0) + 1
+        for metric, bounds in METRICS:
+            value = summary[metric]
+            for key, delta in (
+                    ('%s|%s|sum' % (route, metric), int(round(value))),
+                    ('%s|%s|%s' % (route, metric, _bucket(value, bounds)),
+                     1)):
+                _pending[key] = _pending.get(key, 0) + delta
+        due = time.time() - _last_flush[0] >= FLUSH_SECONDS
+    if due:
+        flush()
+
+def flush():
+    """Add this instance's pending aggregates to memcache"""
+    with _pending_lock:
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush[0] = time.time()
+    if pending:
+        memcache.offset_multi(pending, namespace=NAMESPACE, initial_value=0)
+
+def load(routes):
+    """Aggregated stats for routes, from every instance
+
+    Returns a list with a dict per route: route, requests, and metrics,
+    a list of dicts with name, mean and buckets ((label, count) pairs).
+    """
+    keys = []
+    for route in routes:
+        keys.append('%s|requests' % route)
+        for metric, bounds in METRICS:
+            keys.append('%s|%s|sum' % (route, metric))
+            keys.extend('%s|%s|%s' % (route, metric, label)
+                        for label in [str(b) for b in bounds] + ['inf'])
+    values = memcache.get_multi(keys, namespace=NAMESPACE)
+
+    result = []
+    for route in routes:
+        requests = int(values.get('%s|requests' % route, 0))
+        metrics = []
+        for metric, bounds in METRICS:
+            total = int(values.get('%s|%s|sum' % (route, metric), 0))
+            metrics.append({
+                'name': metric,
+                'mean': float(total) / requests if requests else 0.0,
+                'buckets': [(label, int(values.get(
+                    '%s|%s|%s' % (route, metric, label), 0)))
+                            for label in [str(b) for b in bounds] + ['inf']]})
+        result.append({'route': route, 'requests': requests,
+                       'metrics': metrics})
+    return result